@@ -0,0 +1,190 @@
+# Public Domain (-) 2014 The Wikifactory Authors.
+# See the Wikifactory UNLICENSE file for details.
+
+"""Microbenchmarks for weblite.
+
+Run from within the ``app`` directory, e.g.
+
+    python benchmark.py [name ...]
+
+"""
+
+import sys
+
+from os.path import dirname, exists, join
+from time import time
+from urllib import quote as urlquote
+
+SDK_PATH = join(dirname(__file__) or '.', '..', '.appengine_python_sdk')
+if exists(SDK_PATH):
+    sys.path.insert(0, SDK_PATH)
+
+import weblite
+
+BENCHMARKS = []
+
+def register(func):
+    BENCHMARKS.append((func.__name__, func))
+    return func
+
+def timeit(label, func, repeat=20):
+    best = None
+    for _ in range(repeat):
+        start = time()
+        func()
+        duration = time() - start
+        if best is None or duration < best:
+            best = duration
+    print "  %-24s %8.3fms" % (label, best * 1000)
+    return best
+
+def get_context(host='www.example.com', ssl_mode=False):
+    env = {
+        'HTTP_HOST': host,
+        'PATH_INFO': '/listing',
+        'QUERY_STRING': 'page=2',
+        'REQUEST_METHOD': 'GET',
+        'wsgi.url_scheme': ssl_mode and 'https' or 'http'
+        }
+    return weblite.Context(env, ssl_mode)
+
+# ------------------------------------------------------------------------------
+# URL Building
+# ------------------------------------------------------------------------------
+
+# The implementation of ``Context.compute_url_for_host`` prior to memoisation.
+def legacy_compute_url(ctx, *args, **kwargs):
+    out = ctx.scheme + '://' + ctx.host + '/' + '/'.join(
+        arg.encode('utf-8') for arg in args
+        )
+    if kwargs:
+        out += '?'
+        _set = 0
+        _l = ''
+        for key, value in kwargs.items():
+            key = urlquote(key).replace(' ', '+')
+            if value is None:
+                value = ''
+            if isinstance(value, list):
+                for val in value:
+                    if _set: _l = '&'
+                    out += '%s%s=%s' % (
+                        _l, key,
+                        urlquote(val.encode('utf-8')).replace(' ', '+')
+                        )
+                    _set = 1
+            else:
+                if _set: _l = '&'
+                out += '%s%s=%s' % (
+                    _l, key, urlquote(value.encode('utf-8')).replace(' ', '+')
+                    )
+                _set = 1
+    return out
+
+@register
+def compute_url(links=500):
+    """generate the links for a listing page"""
+
+    ctx = get_context()
+    items = [u'item-%d' % i for i in range(links)]
+    tags = [u'open hardware', u'caf\xe9']
+
+    def legacy():
+        return [
+            legacy_compute_url(ctx, u'thing', item, ref=u'listing', tag=tags)
+            for item in items
+            ] + [legacy_compute_url(ctx, 'login', return_to=ctx.url_with_qs)]
+
+    def memoised():
+        return [
+            ctx.compute_url(u'thing', item, ref=u'listing', tag=tags)
+            for item in items
+            ] + [ctx.get_login_url()]
+
+    def template():
+        return ctx.compute_url_template(u'thing').build_many(
+            items, ref=u'listing', tag=tags
+            ) + [ctx.get_login_url()]
+
+    expected = legacy()
+    for func in (memoised, template):
+        if func() != expected:
+            raise AssertionError("Mismatched URLs from %s" % func.__name__)
+
+    # Check the edge cases for identical output too.
+    for args, kwargs in [
+        ((), {}),
+        ((u'a', u'b'), {}),
+        ((u'caf\xe9',), {'q': None}),
+        ((u'a',), {'q': [], 'x': u'1 2'}),
+        ((u'a/',), {'q': [u'&', u'=']}),
+        ]:
+        if ctx.compute_url(*args, **kwargs) != legacy_compute_url(
+            ctx, *args, **kwargs
+            ):
+            raise AssertionError("Mismatched URL for %r %r" % (args, kwargs))
+
+    timeit("legacy", legacy)
+    timeit("compute_url", memoised)
+    timeit("build_many", template)
+
+# ------------------------------------------------------------------------------
+# Templates
+# ------------------------------------------------------------------------------
+
+TABLE_TEMPLATE = u"""\
+<table>
+% for row in rows:
+<tr class="${row['kind']}">
+  <td><a href="${row['url'] | h}">${row['title'] | h}</a></td>
+  <td>${row['author'] | h}</td>
+  <td>${row['likes']}</td>
+  <td>${row['summary'] | h}</td>
+  <td>${row['badge'] | h}</td>
+</tr>
+% endfor
+</table>
+"""
+
+def get_rows(count):
+    rows = []
+    for i in range(count):
+        rows.append({
+            'author': i % 3 and u'caf\xe9 & co' or 'plain',
+            'badge': weblite.Markup(u'<b>%d</b>' % (i % 7)),
+            'kind': i % 2 and 'odd' or u'even',
+            'likes': i,
+            'summary': u'Said "hi" <b>it\'s</b> %d' % i,
+            'title': 'Thing \xe2\x84\xa2 #%d' % i,
+            'url': u'/thing/%d?a=1&b=2' % i
+            })
+    return rows
+
+@register
+def table_template(rows=5000):
+    """render a table template with escaped cells"""
+
+    args = weblite.MakoTemplateLookup.default_template_args.copy()
+    args['cache_enabled'] = False
+    current = weblite.MakoTemplate(TABLE_TEMPLATE, **args)
+    args.update({'default_filters': ['decode.utf8'], 'imports': None})
+    legacy = weblite.MakoTemplate(TABLE_TEMPLATE, **args)
+
+    rows = get_rows(rows)
+    if current.render(rows=rows) != legacy.render(rows=rows):
+        raise AssertionError("Mismatched template output")
+
+    timeit("decode.utf8", lambda: legacy.render(rows=rows), 10)
+    timeit("to_unicode", lambda: current.render(rows=rows), 10)
+
+# ------------------------------------------------------------------------------
+# Runner
+# ------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    names = sys.argv[1:]
+    for name, func in BENCHMARKS:
+        if names and name not in names:
+            continue
+        print "%s: %s" % (name, func.__doc__)
+        func()
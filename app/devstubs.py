@@ -0,0 +1,41 @@
+# Public Domain (-) 2014 The Wikifactory Authors.
+# See the Wikifactory UNLICENSE file for details.
+
+"""Local stand-ins for the App Engine APIs, for running the app outside of
+App Engine and ``dev_appserver.py``.
+
+The APIs are backed by the SDK's ``testbed`` stubs, which keep their state in
+memory within the current process.
+"""
+
+import os
+import sys
+
+from os.path import abspath, dirname, exists, join
+
+APP_ROOT = dirname(abspath(__file__))
+SDK_PATH = join(APP_ROOT, '..', '.appengine_python_sdk')
+
+def setup_stubs():
+    if exists(SDK_PATH):
+        sys.path.insert(0, SDK_PATH)
+        import dev_appserver
+        dev_appserver.fix_sys_path()
+    from google.appengine.ext import testbed
+    bed = testbed.Testbed()
+    bed.activate()
+    # The testbed looks like the dev_appserver to the app, so flag that
+    # requests aren't joined with the threads they start.
+    os.environ['WEBLITE_DEVSTUBS'] = '1'
+    bed.init_app_identity_stub()
+    bed.init_blobstore_stub()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=APP_ROOT)
+    bed.init_urlfetch_stub()
+    bed.init_user_stub()
+    return bed
+
+def load_app(path='main.app'):
+    module, attr = path.rsplit('.', 1)
+    return getattr(__import__(module, {}, {}, [attr]), attr)
@@ -0,0 +1,253 @@
+# Public Domain (-) 2014 The Wikifactory Authors.
+# See the Wikifactory UNLICENSE file for details.
+
+"""Replay a request log against the app in-process.
+
+Run from within the ``app`` directory, e.g.
+
+    python loadtest.py requests.log --threads 8 --rate 200
+
+The log has one request per line, either as a JSON object with the keys
+``method``, ``path``, ``query``, ``cookies``, ``body`` and ``content_type``, or
+as a plain ``METHOD /path?query`` line. Only ``path`` is required, and the
+method defaults to GET.
+
+Note that weblite's access log records only carry the ``method`` and ``path``.
+They load as is, but replaying them drops any query parameters, cookies and
+bodies, and so may exercise different code paths to the original requests.
+
+Requests are issued by a pool of threads. Without a ``--rate`` each thread sends
+its next request as soon as the previous one completes. With a ``--rate`` the
+requests arrive on an open-loop schedule instead, and latencies are measured
+from each request's scheduled arrival, so that queueing delays are included.
+
+The App Engine APIs are backed by the local stand-ins from ``devstubs``.
+"""
+
+import sys
+
+from Queue import Queue
+from collections import deque
+from cStringIO import StringIO
+from json import dumps as encode_json, loads as decode_json
+from math import ceil
+from optparse import OptionParser
+from threading import Thread, local
+from time import sleep, time
+from urllib import quote as urlquote
+
+from devstubs import load_app, setup_stubs
+
+# ------------------------------------------------------------------------------
+# Request Log
+# ------------------------------------------------------------------------------
+
+def load_requests(path):
+    requests = []
+    f = open(path, 'rb')
+    for line in f:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('{'):
+            request = decode_json(line)
+        else:
+            method, url = line.split(None, 1)
+            path, _, query = url.partition('?')
+            request = {'method': method, 'path': path, 'query': query}
+        requests.append(request)
+    f.close()
+    return requests
+
+def get_environ(request, host):
+    body = request.get('body') or ''
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+    cookies = request.get('cookies') or ''
+    if isinstance(cookies, dict):
+        cookies = '; '.join(
+            '%s=%s' % (name, urlquote(value))
+            for name, value in sorted(cookies.items())
+            )
+    path = request['path']
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    return {
+        'CONTENT_LENGTH': str(len(body)),
+        'CONTENT_TYPE': str(request.get('content_type') or ''),
+        'HTTP_COOKIE': str(cookies),
+        'HTTP_HOST': host,
+        'PATH_INFO': path,
+        'QUERY_STRING': str(request.get('query') or ''),
+        'REMOTE_ADDR': str(request.get('remote_addr') or '127.0.0.1'),
+        'REQUEST_METHOD': str(request.get('method') or 'GET'),
+        'SERVER_NAME': host.split(':')[0],
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'wsgi.errors': sys.stderr,
+        'wsgi.input': StringIO(body),
+        'wsgi.multiprocess': False,
+        'wsgi.multithread': True,
+        'wsgi.run_once': False,
+        'wsgi.url_scheme': 'http',
+        'wsgi.version': (1, 0)
+        }
+
+# ------------------------------------------------------------------------------
+# Runner
+# ------------------------------------------------------------------------------
+
+# Capture the handler name of each request from the access log record that
+# weblite submits on the thread which served it.
+def capture_handlers(weblite):
+    captured = local()
+    access_log = weblite.handle_http_request.access_log
+    submit = access_log.submit
+    def capture(record):
+        captured.handler = record['handler']
+        return submit(record)
+    access_log.submit = capture
+    access_log.enabled = True
+    return captured
+
+def run(app, requests, captured, threads=8, rate=None, host='localhost:8080'):
+
+    results = []
+    record = results.append
+
+    def serve(request, scheduled):
+        status = []
+        def start_response(status_line, headers, exc_info=None):
+            status.append(status_line)
+        captured.handler = None
+        try:
+            body = app(get_environ(request, host), start_response)
+            for _ in body:
+                pass
+            if hasattr(body, 'close'):
+                body.close()
+            code = int(status[0][:3])
+        except Exception:
+            code = 0
+        record((captured.handler or '-', code, time() - scheduled))
+
+    if rate:
+        queue = Queue()
+        def worker():
+            while 1:
+                item = queue.get()
+                if item is None:
+                    return
+                serve(*item)
+    else:
+        pending = deque(requests)
+        def worker():
+            while 1:
+                try:
+                    request = pending.popleft()
+                except IndexError:
+                    return
+                serve(request, time())
+
+    pool = [Thread(target=worker) for _ in range(threads)]
+    start = time()
+    for thread in pool:
+        thread.start()
+
+    if rate:
+        interval = 1.0 / rate
+        for idx, request in enumerate(requests):
+            scheduled = start + idx * interval
+            delay = scheduled - time()
+            if delay > 0:
+                sleep(delay)
+            queue.put((request, scheduled))
+        for _ in pool:
+            queue.put(None)
+
+    for thread in pool:
+        thread.join()
+
+    return summarise(results, time() - start)
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    idx = int(ceil(pct / 100.0 * len(values))) - 1
+    return values[max(0, min(idx, len(values) - 1))]
+
+def summarise(results, duration):
+    by_handler = {}
+    for handler, code, latency in results:
+        by_handler.setdefault(handler, []).append((code, latency))
+    by_handler['*'] = [(code, latency) for _, code, latency in results]
+    stats = {}
+    for handler, entries in by_handler.iteritems():
+        latencies = sorted(latency for _, latency in entries)
+        errors = len([code for code, _ in entries if not code or code >= 500])
+        stats[handler] = {
+            'count': len(entries),
+            'errors': errors,
+            'error_rate': errors / float(len(entries)),
+            'throughput': len(entries) / duration,
+            'p50': percentile(latencies, 50) * 1000,
+            'p95': percentile(latencies, 95) * 1000,
+            'p99': percentile(latencies, 99) * 1000,
+            'max': latencies[-1] * 1000
+            }
+    return {'duration': duration, 'handlers': stats}
+
+def print_report(report):
+    print "Completed in %.2fs\n" % report['duration']
+    print "%-24s %7s %9s %7s %9s %9s %9s %9s" % (
+        'handler', 'count', 'req/s', 'errors', 'p50 ms', 'p95 ms', 'p99 ms',
+        'max ms'
+        )
+    for handler, stats in sorted(report['handlers'].items()):
+        print "%-24s %7d %9.1f %6.2f%% %9.2f %9.2f %9.2f %9.2f" % (
+            handler[:24], stats['count'], stats['throughput'],
+            stats['error_rate'] * 100, stats['p50'], stats['p95'],
+            stats['p99'], stats['max']
+            )
+
+# ------------------------------------------------------------------------------
+# Main
+# ------------------------------------------------------------------------------
+
+def main(argv=None):
+
+    op = OptionParser(usage="Usage: %prog [options] <request-log>")
+    op.add_option('--app', default='main.app', help="the WSGI app [main.app]")
+    op.add_option('--threads', type='int', default=8, help="worker threads [8]")
+    op.add_option('--rate', type='float', help="open-loop arrivals per second")
+    op.add_option('--repeat', type='int', default=1, help="replay the log N times")
+    op.add_option('--warmup', type='int', default=0, help="unmeasured requests")
+    op.add_option('--output', help="write the report as JSON to this file")
+
+    options, args = op.parse_args(argv)
+    if len(args) != 1:
+        op.error("a request log must be specified")
+
+    requests = load_requests(args[0]) * options.repeat
+    if not requests:
+        op.error("no requests found in %s" % args[0])
+
+    setup_stubs()
+    app = load_app(options.app)
+
+    import weblite
+    captured = capture_handlers(weblite)
+
+    if options.warmup:
+        run(app, requests[:options.warmup], captured, options.threads)
+
+    report = run(app, requests, captured, options.threads, options.rate)
+    print_report(report)
+
+    if options.output:
+        f = open(options.output, 'wb')
+        f.write(encode_json(report, indent=2, sort_keys=True))
+        f.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+# Public Domain (-) 2014 The Wikifactory Authors.
+# See the Wikifactory UNLICENSE file for details.
+
+"""Detect media types from the leading bytes of a stream.
+
+This mirrors the signatures of the Go ``files/mediatype`` package. Instead of a
+linear scan over every signature, entries are bucketed by the byte found at the
+offset of their first signature, so that a lookup only checks the handful of
+entries which could possibly match.
+"""
+
+DEFAULT_MEDIA_TYPE = 'application/octet-stream'
+
+# Each entry is a media type followed by one or more signatures. A signature is
+# either a string which must be found at the start of the data, or an
+# ``(offset, string)`` tuple. All of an entry's signatures must match. Entries
+# are tried in order, so image types go first as a minor optimisation.
+SIGNATURES = [
+    ('image/gif', 'GIF87a'),
+    ('image/gif', 'GIF89a'),
+    ('image/jpeg', '\xff\xd8\xff'),
+    ('image/png', '\x89PNG\r\n\x1a\n'),
+    ('image/tiff', 'II*\x00'),
+    ('image/tiff', 'MM\x00*'),
+    ('application/pdf', '%PDF'),
+    ('image/bmp', 'BM', (6, '\x00\x00\x00\x00')),
+    ('image/webp', 'RIFF', (8, 'WEBPVP8')),
+    ]
+
+class MediaTypeDetector(object):
+
+    def __init__(self, signatures=()):
+        self._entries = []
+        self._index = ()
+        self.sniff_length = 0
+        for entry in signatures:
+            self.register(*entry)
+
+    def register(self, media_type, *signatures):
+        if not signatures:
+            raise ValueError("No signatures specified for %s" % media_type)
+        sigs = []
+        for sig in signatures:
+            if isinstance(sig, tuple):
+                offset, sig = sig
+            else:
+                offset = 0
+            if not sig:
+                raise ValueError("Empty signature specified for %s" % media_type)
+            sigs.append((offset, sig))
+        self._entries.append((len(self._entries), media_type, tuple(sigs)))
+        self._compile()
+
+    # The index maps an offset to a dict of the byte expected at that offset to
+    # the entries keyed on it. It is rebuilt and swapped in as a whole so that
+    # concurrent lookups never see a partially built index.
+    def _compile(self):
+        index = {}
+        length = 0
+        for entry in self._entries:
+            sigs = entry[2]
+            offset, sig = sigs[0]
+            index.setdefault(offset, {}).setdefault(sig[0], []).append(entry)
+            for offset, sig in sigs:
+                length = max(length, offset + len(sig))
+        self._index = sorted(index.items())
+        self.sniff_length = length
+
+    def detect(self, data, default=DEFAULT_MEDIA_TYPE):
+        candidates = None
+        size = len(data)
+        for offset, buckets in self._index:
+            if offset >= size:
+                break
+            bucket = buckets.get(data[offset])
+            if bucket:
+                if candidates is None:
+                    candidates = bucket
+                else:
+                    candidates = sorted(candidates + bucket)
+        if not candidates:
+            return default
+        for _, media_type, sigs in candidates:
+            for offset, sig in sigs:
+                if not data.startswith(sig, offset):
+                    break
+            else:
+                return media_type
+        return default
+
+detector = MediaTypeDetector(SIGNATURES)
+detect = detector.detect
+register_signature = detector.register
+
+# ------------------------------------------------------------------------------
+# Benchmark
+# ------------------------------------------------------------------------------
+
+def detect_linear(data, default=DEFAULT_MEDIA_TYPE, entries=detector._entries):
+    for _, media_type, sigs in entries:
+        for offset, sig in sigs:
+            if not data.startswith(sig, offset):
+                break
+        else:
+            return media_type
+    return default
+
+def benchmark(count=200000):
+
+    from random import Random
+    from time import time
+
+    rand = Random(42)
+    corpus = []
+    for _, _, sigs in detector._entries:
+        head = bytearray(rand.getrandbits(8) for _ in range(64))
+        for offset, sig in sigs:
+            head[offset:offset+len(sig)] = sig
+        corpus.append(str(head))
+    # Unknown uploads, e.g. text and archives, make up a good share of a mixed
+    # corpus and exercise the miss path.
+    corpus.append('PK\x03\x04' + 'x' * 60)
+    corpus.append('\x1f\x8b\x08\x00' + 'x' * 60)
+    corpus.append('Hello, world!\n' * 5)
+    corpus.append('<!DOCTYPE html>' + ' ' * 50)
+    corpus = [rand.choice(corpus) for _ in range(count)]
+
+    for data in corpus[:1000]:
+        if detect(data) != detect_linear(data):
+            raise AssertionError("Mismatched detection for %r" % data[:16])
+
+    for name, func in [('linear', detect_linear), ('indexed', detect)]:
+        start = time()
+        for data in corpus:
+            func(data)
+        duration = time() - start
+        print "%-8s %8.0f detections/sec" % (name, count / duration)
+
+if __name__ == '__main__':
+    benchmark()
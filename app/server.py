@@ -0,0 +1,352 @@
+# Public Domain (-) 2014 The Wikifactory Authors.
+# See the Wikifactory UNLICENSE file for details.
+
+"""A pre-forking, multi-threaded server for running the app on plain boxes.
+
+Run from within the ``app`` directory, e.g.
+
+    python server.py --port 8080 --workers 4 --threads 8
+
+The master process binds the listening socket and forks the workers, which each
+serve requests from a bounded pool of threads. The master never imports the
+app itself. So, when ``pregen.py`` or any of the templates change, or on a
+SIGHUP, it forks a fresh set of workers and gracefully retires the old ones,
+which finish their in-flight requests before exiting.
+
+Each worker periodically writes its health stats to the ``--stats-dir``, and
+the stats of all workers are served as JSON at ``/__health__``.
+
+The App Engine APIs are backed by the local stand-ins from ``devstubs``, so
+datastore and memcache state is not shared between workers.
+"""
+
+import errno
+import os
+import signal
+import socket
+
+from Queue import Queue
+from SocketServer import BaseServer
+from json import dumps as encode_json, loads as decode_json
+from optparse import OptionParser
+from os.path import exists, getmtime, isfile, join
+from resource import RUSAGE_SELF, getrusage
+from select import error as select_error
+from threading import Lock, Thread
+from time import sleep, time
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+HEALTH_PATH = '/__health__'
+WATCHED_FILES = ['pregen.py']
+WATCHED_DIRECTORIES = ['template']
+
+# ------------------------------------------------------------------------------
+# Worker
+# ------------------------------------------------------------------------------
+
+class RequestHandler(WSGIRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+# The ``PooledWSGIServer`` serves the requests accepted on an inherited socket
+# with a fixed pool of threads. At most ``threads`` accepted connections wait
+# for a free thread. Once that many are waiting, the worker blocks and stops
+# accepting, so that new connections go to the other workers.
+class PooledWSGIServer(WSGIServer):
+
+    def __init__(self, sock, address, app, threads, stats):
+        BaseServer.__init__(self, address, RequestHandler)
+        self.socket = sock
+        self.server_name = socket.getfqdn(address[0])
+        self.server_port = address[1]
+        self.setup_environ()
+        self.set_app(app)
+        self.stats = stats
+        self.timeout = 0.5
+        self._queue = Queue(threads)
+        self._threads = [Thread(target=self._work) for _ in range(threads)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def process_request(self, request, client_address):
+        self._queue.put((request, client_address))
+
+    def _work(self):
+        while 1:
+            item = self._queue.get()
+            if item is None:
+                return
+            request, client_address = item
+            self.stats.start_request()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                self.stats.finish_request()
+
+    def drain(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+class WorkerStats(object):
+
+    def __init__(self, generation, threads, path):
+        self.path = path
+        self._lock = Lock()
+        self._data = {
+            'active': 0,
+            'errors': 0,
+            'generation': generation,
+            'last_request': None,
+            'max_active': 0,
+            'pid': os.getpid(),
+            'requests': 0,
+            'started': time(),
+            'threads': threads
+            }
+
+    def start_request(self):
+        with self._lock:
+            data = self._data
+            data['active'] += 1
+            if data['active'] > data['max_active']:
+                data['max_active'] = data['active']
+
+    def finish_request(self):
+        with self._lock:
+            data = self._data
+            data['active'] -= 1
+            data['requests'] += 1
+            data['last_request'] = time()
+
+    def record_status(self, status):
+        if status[:1] == '5':
+            with self._lock:
+                self._data['errors'] += 1
+
+    def get(self):
+        with self._lock:
+            data = self._data.copy()
+        data['max_rss'] = getrusage(RUSAGE_SELF).ru_maxrss
+        data['uptime'] = time() - data['started']
+        return data
+
+    def write(self):
+        tmp = '%s.tmp' % self.path
+        f = open(tmp, 'wb')
+        f.write(encode_json(self.get()))
+        f.close()
+        os.rename(tmp, self.path)
+
+    def remove(self):
+        if isfile(self.path):
+            os.remove(self.path)
+
+def get_all_stats(stats_dir):
+    workers = []
+    for filename in sorted(os.listdir(stats_dir)):
+        if not filename.endswith('.json'):
+            continue
+        try:
+            f = open(join(stats_dir, filename), 'rb')
+            workers.append(decode_json(f.read()))
+            f.close()
+        except (IOError, ValueError):
+            continue
+    return {'workers': workers}
+
+def wrap_app(app, stats, stats_dir):
+    def serve(env, start_response):
+        if env['PATH_INFO'] == HEALTH_PATH:
+            body = encode_json(get_all_stats(stats_dir))
+            start_response('200 OK', [
+                ('Content-Type', 'application/json'),
+                ('Content-Length', str(len(body)))
+                ])
+            return [body]
+        def _start_response(status, headers, exc_info=None):
+            stats.record_status(status)
+            return start_response(status, headers, exc_info)
+        return app(env, _start_response)
+    return serve
+
+def run_worker(sock, address, options, generation):
+
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda *args: stopping.append(1))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    from devstubs import load_app, setup_stubs
+    setup_stubs()
+
+    stats = WorkerStats(
+        generation, options.threads,
+        join(options.stats_dir, 'worker-%d.json' % os.getpid())
+        )
+
+    app = wrap_app(load_app(options.app), stats, options.stats_dir)
+    server = PooledWSGIServer(sock, address, app, options.threads, stats)
+    next_write = 0
+
+    try:
+        while not stopping:
+            try:
+                server.handle_request()
+            except (OSError, select_error), err:
+                if err.args[0] != errno.EINTR:
+                    raise
+            now = time()
+            if now >= next_write:
+                stats.write()
+                next_write = now + options.stats_interval
+        server.drain()
+    finally:
+        stats.remove()
+
+    os._exit(0)
+
+# ------------------------------------------------------------------------------
+# Master
+# ------------------------------------------------------------------------------
+
+def get_watched_mtime():
+    latest = 0
+    for path in WATCHED_FILES:
+        if exists(path):
+            latest = max(latest, getmtime(path))
+    for directory in WATCHED_DIRECTORIES:
+        for root, dirs, files in os.walk(directory):
+            for filename in files:
+                if filename.endswith('.mako'):
+                    latest = max(latest, getmtime(join(root, filename)))
+    return latest
+
+class Master(object):
+
+    def __init__(self, options):
+        self.options = options
+        self.generation = 0
+        self.workers = {}
+        self.retiring = set()
+        self.signals = []
+
+    def bind(self):
+        options = self.options
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((options.host, options.port))
+        sock.listen(options.backlog)
+        self.socket = sock
+        self.address = sock.getsockname()
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = self.generation
+            return
+        try:
+            run_worker(self.socket, self.address, self.options, self.generation)
+        except Exception:
+            import traceback
+            traceback.print_exc()
+        os._exit(1)
+
+    def spawn_generation(self):
+        self.generation += 1
+        old = [
+            pid for pid, generation in self.workers.items()
+            if pid not in self.retiring
+            ]
+        for _ in range(self.options.workers):
+            self.spawn()
+        for pid in old:
+            self.retire(pid)
+
+    def retire(self, pid):
+        self.retiring.add(pid)
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    def reap(self):
+        while 1:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, err:
+                if err.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            generation = self.workers.pop(pid, None)
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+            elif generation == self.generation and not self.signals:
+                print "!! Worker %d exited unexpectedly, respawning" % pid
+                self.spawn()
+
+    def run(self):
+        options = self.options
+        if not exists(options.stats_dir):
+            os.makedirs(options.stats_dir)
+        self.bind()
+        signal.signal(signal.SIGHUP, lambda *args: self.signals.append('reload'))
+        signal.signal(signal.SIGTERM, lambda *args: self.signals.append('stop'))
+        signal.signal(signal.SIGINT, lambda *args: self.signals.append('stop'))
+        print ">> Serving %s on http://%s:%d with %d workers x %d threads" % (
+            options.app, self.address[0], self.address[1], options.workers,
+            options.threads
+            )
+        self.spawn_generation()
+        mtime = get_watched_mtime()
+        while 1:
+            sleep(options.reload_interval)
+            signals, self.signals[:] = self.signals[:], []
+            if 'stop' in signals:
+                break
+            self.reap()
+            latest = get_watched_mtime()
+            if latest != mtime or 'reload' in signals:
+                mtime = latest
+                print ">> Reloading workers"
+                self.spawn_generation()
+        print ">> Stopping workers"
+        for pid in self.workers.keys():
+            self.retire(pid)
+        while self.workers:
+            self.reap()
+            sleep(0.1)
+
+# ------------------------------------------------------------------------------
+# Main
+# ------------------------------------------------------------------------------
+
+def main(argv=None):
+
+    op = OptionParser(usage="Usage: %prog [options]")
+    op.add_option('--app', default='main.app', help="the WSGI app [main.app]")
+    op.add_option('--host', default='127.0.0.1', help="the interface [127.0.0.1]")
+    op.add_option('--port', type='int', default=8080, help="the port [8080]")
+    op.add_option('--workers', type='int', default=4, help="worker processes [4]")
+    op.add_option('--threads', type='int', default=8, help="threads per worker [8]")
+    op.add_option('--backlog', type='int', default=128, help="listen backlog [128]")
+    op.add_option('--reload-interval', type='float', default=1.0,
+                  help="seconds between checks for changed files [1.0]")
+    op.add_option('--stats-dir', default='.serve',
+                  help="where workers write their stats [.serve]")
+    op.add_option('--stats-interval', type='float', default=2.0,
+                  help="seconds between stats updates [2.0]")
+
+    options, args = op.parse_args(argv)
+    Master(options).run()
+
+if __name__ == '__main__':
+    main()
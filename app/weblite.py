@@ -3,6 +3,7 @@
 
 """A sexy micro-framework for use with Google App Engine."""
 
+import atexit
 import logging
 import os
 import sys
@@ -10,15 +11,23 @@ import sys
 from BaseHTTPServer import BaseHTTPRequestHandler
 from binascii import hexlify
 from cgi import FieldStorage
+from collections import OrderedDict, deque
 from Cookie import SimpleCookie
 from cStringIO import StringIO
 from datetime import datetime
+from email.utils import formatdate, mktime_tz, parsedate_tz
+from hashlib import sha1
 from json import dumps as encode_json, loads as json_decode
 from md5 import md5
+from mimetypes import guess_type
+from mmap import ACCESS_READ, mmap
+from Queue import Empty, Full, Queue
 
 from os import urandom
-from os.path import dirname, exists, join as join_path, getmtime
-from threading import local
+from os.path import dirname, exists, join as join_path, getmtime, isfile
+from random import random
+from threading import Event, Lock, Thread, local
+from time import time
 from traceback import format_exception
 from urllib import quote as urlquote, unquote as urlunquote
 from urlparse import urljoin
@@ -43,6 +52,13 @@ from tavutil.crypto import (
 from webob import Request as WebObRequest # this import patches cgi.FieldStorage
                                           # to behave better for us too!
 
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from mediatype import detector as media_type_detector
+
 from config import (
     DEBUG, SECURE_COOKIE_DURATION, SECURE_COOKIE_KEY,
     STATIC_HTTP_HOSTS, STATIC_HTTPS_HOSTS, STATIC_PATH
@@ -82,19 +98,31 @@ RESPONSE_HEADERS_HTML = [
 
 STATUS_301 = "301 Moved Permanently"
 STATUS_302 = "302 Found"
+STATUS_429 = "429 Too Many Requests"
+STATUS_503 = "503 Service Unavailable"
 
 RESPONSE_401 = ("401 Unauthorized", RESPONSE_HEADERS_HTML +
                 [("WWW-Authenticate", "Token realm='Service', error='token_expired'")])
 RESPONSE_403 = ("403 Forbidden", RESPONSE_HEADERS_HTML)
 RESPONSE_404 = ("404 Not Found", RESPONSE_HEADERS_HTML)
 RESPONSE_500 = ("500 Server Error", RESPONSE_HEADERS_HTML)
-RESPONSE_503 = ("503 Service Unavailable", RESPONSE_HEADERS_HTML)
+RESPONSE_503 = (STATUS_503, RESPONSE_HEADERS_HTML)
 
 if os.environ.get('SERVER_SOFTWARE', '').startswith('Google'):
     RUNNING_ON_GOOGLE_SERVERS = True
 else:
     RUNNING_ON_GOOGLE_SERVERS = False
 
+# App Engine, including the dev_appserver, joins any threads started within a
+# request once it ends. So background threads are only used outside of it, e.g.
+# when running with the local ``devstubs`` under ``server.py``.
+if os.environ.get('SERVER_SOFTWARE', '').startswith(
+    ('Google', 'Development')
+    ) and not os.environ.get('WEBLITE_DEVSTUBS'):
+    BACKGROUND_THREADS = False
+else:
+    BACKGROUND_THREADS = True
+
 HANDLERS = {}
 SUPPORTED_HTTP_METHODS = frozenset(['GET', 'HEAD', 'POST'])
 
@@ -133,6 +161,11 @@ except ImportError:
 %%s
 """ % (SITE_CSS_PATH, SITE_CSS_PATH, SITE_CSS_IE_PATH)
 
+    # Let browsers fetch the stylesheet of the error pages early.
+    ERROR_PRELOAD_HEADER = ('Link', '<%s>; rel=preload; as=style' % SITE_CSS_PATH)
+    RESPONSE_HEADERS_HTML.append(ERROR_PRELOAD_HEADER)
+    RESPONSE_401[1].append(ERROR_PRELOAD_HEADER)
+
     ERROR_401 = ERROR_WRAPPER % """
   <div class="site-error">
     <h1>Not Authorized</h1>
@@ -228,6 +261,12 @@ class HTTPError(BaseHTTPError):
     def __init__(self, code=500):
         self.code = code
 
+# The ``Overloaded`` exception is used to shed requests with a 429/503 response.
+class Overloaded(BaseHTTPError):
+    def __init__(self, status, retry_after):
+        self.status = status
+        self.retry_after = retry_after
+
 # ------------------------------------------------------------------------------
 # Static
 # ------------------------------------------------------------------------------
@@ -262,6 +301,244 @@ else:
             ctx.host, prefix, assets[path]
             ))
 
+try:
+    from config import SERVE_STATIC
+except ImportError:
+    SERVE_STATIC = not RUNNING_ON_GOOGLE_SERVERS
+
+# The ``FileRange`` iterates over a byte range of a file in blocks, read from a
+# memory map of the file rather than into one big string.
+class FileRange(object):
+
+    def __init__(self, file, start, length, block_size):
+        self.file = file
+        self.start = start
+        self.length = length
+        self.block_size = block_size
+
+    def __iter__(self):
+        if not self.length:
+            return
+        data = mmap(self.file.fileno(), 0, access=ACCESS_READ)
+        try:
+            end = self.start + self.length
+            block_size = self.block_size
+            for pos in xrange(self.start, end, block_size):
+                yield data[pos:min(pos + block_size, end)]
+        finally:
+            data.close()
+
+    def close(self):
+        self.file.close()
+
+# The ``StaticFiles`` app serves the files generated into the ``build``
+# directory, where App Engine's ``static_dir`` isn't available, e.g. on dev and
+# self-hosted instances. Only the hashed files listed in ``assets.json`` are
+# served, and so they are cached for a year.
+#
+# Full responses are handed to the server's ``wsgi.file_wrapper`` so that it
+# can use sendfile. Byte ranges and conditional requests are supported, and a
+# precompressed ``.gz`` sibling is served to clients which accept gzip.
+class StaticFiles(object):
+
+    block_size = 64 * 1024
+    directory = 'build'
+    max_age = 31536000
+
+    def __init__(self, prefix=STATIC_PATH, manifest='assets.json'):
+        if not prefix.endswith('/'):
+            prefix += '/'
+        self.prefix = prefix
+        self.manifest = manifest
+        self._files = frozenset()
+        self._manifest_mtime = None
+
+    def get_files(self):
+        mtime = getmtime(self.manifest)
+        if mtime != self._manifest_mtime:
+            self._files = frozenset(json_decode(read(self.manifest)).values())
+            self._manifest_mtime = mtime
+        return self._files
+
+    def __call__(self, env, start_response):
+
+        name = env['PATH_INFO'][len(self.prefix):]
+        if env['REQUEST_METHOD'] not in ('GET', 'HEAD') or (
+            name not in self.get_files()
+            ):
+            start_response(*RESPONSE_404)
+            return [ERROR_404]
+
+        path = join_path(self.directory, name)
+        if not isfile(path):
+            start_response(*RESPONSE_404)
+            return [ERROR_404]
+
+        content_type, _ = guess_type(name)
+        if not content_type:
+            content_type = 'application/octet-stream'
+        elif content_type.startswith('text/') or content_type.endswith(
+            'javascript'
+            ):
+            content_type += '; charset=utf-8'
+
+        byte_range = env.get('HTTP_RANGE')
+        headers = [
+            ('Accept-Ranges', 'bytes'),
+            ('Cache-Control', 'public, max-age=%d' % self.max_age),
+            ('Content-Type', content_type),
+            ('Vary', 'Accept-Encoding')
+            ]
+
+        etag = name
+        if (not byte_range) and 'gzip' in env.get('HTTP_ACCEPT_ENCODING', ''):
+            if isfile(path + '.gz'):
+                path += '.gz'
+                etag += '.gz'
+                headers.append(('Content-Encoding', 'gzip'))
+
+        stat = os.stat(path)
+        size = stat.st_size
+        mtime = int(stat.st_mtime)
+        etag = '"%s"' % etag
+        last_modified = formatdate(mtime, usegmt=True)
+
+        headers.extend([
+            ('ETag', etag),
+            ('Expires', formatdate(time() + self.max_age, usegmt=True)),
+            ('Last-Modified', last_modified)
+            ])
+
+        if self.is_not_modified(env, etag, mtime):
+            start_response("304 Not Modified", headers)
+            return []
+
+        start, length = 0, size
+        if byte_range and self.matches_if_range(env, etag, last_modified):
+            byte_range = self.parse_range(byte_range, size)
+            if byte_range == -1:
+                start_response("416 Requested Range Not Satisfiable", [
+                    ('Content-Range', 'bytes */%d' % size)
+                    ])
+                return []
+            if byte_range:
+                start, length = byte_range
+                headers.append(('Content-Range', 'bytes %d-%d/%d' % (
+                    start, start + length - 1, size
+                    )))
+                status = "206 Partial Content"
+            else:
+                status = "200 OK"
+        else:
+            status = "200 OK"
+
+        headers.append(('Content-Length', str(length)))
+        start_response(status, headers)
+
+        if env['REQUEST_METHOD'] == 'HEAD':
+            return []
+
+        file = open(path, 'rb')
+        file_wrapper = env.get('wsgi.file_wrapper')
+        if file_wrapper and length == size:
+            return file_wrapper(file, self.block_size)
+        return FileRange(file, start, length, self.block_size)
+
+    def is_not_modified(self, env, etag, mtime):
+        if_none_match = env.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in tags or etag in tags or ('W/' + etag) in tags
+        if_modified_since = env.get('HTTP_IF_MODIFIED_SINCE')
+        if if_modified_since:
+            timestamp = parsedate_tz(if_modified_since.split(';', 1)[0])
+            if timestamp and mktime_tz(timestamp) >= mtime:
+                return True
+        return False
+
+    def matches_if_range(self, env, etag, last_modified):
+        if_range = env.get('HTTP_IF_RANGE')
+        if not if_range:
+            return True
+        return if_range.strip() in (etag, last_modified)
+
+    # Return a ``(start, length)`` tuple for a satisfiable single byte range,
+    # -1 for an unsatisfiable one, and None if the header should be ignored.
+    def parse_range(self, header, size):
+        unit, _, spec = header.partition('=')
+        if unit.strip() != 'bytes' or ',' in spec:
+            return
+        first, sep, last = spec.strip().partition('-')
+        if not sep:
+            return
+        try:
+            if first:
+                first = int(first)
+                if first >= size:
+                    return -1
+                if last:
+                    last = min(int(last), size - 1)
+                    if last < first:
+                        return
+                else:
+                    last = size - 1
+            elif last:
+                suffix = int(last)
+                if not suffix:
+                    return -1
+                first = max(0, size - suffix)
+                last = size - 1
+            else:
+                return
+        except ValueError:
+            return
+        return first, last - first + 1
+
+# ------------------------------------------------------------------------------
+# Preload
+# ------------------------------------------------------------------------------
+
+# The ``preload.json`` manifest is generated by the build and maps each template
+# to the assets it references, including those of the templates it inherits.
+if exists('preload.json'):
+    PRELOAD_ASSETS = json_decode(read('preload.json'))['templates']
+else:
+    PRELOAD_ASSETS = {}
+
+try:
+    from config import EARLY_HINTS
+except ImportError:
+    EARLY_HINTS = True
+
+PRELOAD_TYPES = {
+    'css': 'style',
+    'gif': 'image',
+    'jpg': 'image',
+    'js': 'script',
+    'otf': 'font',
+    'png': 'image',
+    'svg': 'image',
+    'ttf': 'font',
+    'webp': 'image',
+    'woff': 'font',
+    'woff2': 'font'
+    }
+
+def get_preload_link(ctx, name, cache={}):
+    url = ctx.STATIC(name)
+    if url not in cache:
+        kind = PRELOAD_TYPES.get(name.rsplit('.', 1)[-1])
+        if kind == 'font':
+            link = '<%s>; rel=preload; as=font; crossorigin' % url
+        elif kind:
+            link = '<%s>; rel=preload; as=%s' % (url, kind)
+        else:
+            link = '<%s>; rel=preload' % url
+        if isinstance(link, unicode):
+            link = link.encode('utf-8')
+        cache[url] = link
+    return cache[url]
+
 # ------------------------------------------------------------------------------
 # Handler Utilities
 # ------------------------------------------------------------------------------
@@ -275,8 +552,11 @@ HANDLER_DEFAULT_CONFIG = {
     'admin': False,
     'anon': True,
     'blob': False,
+    'concurrency': None,
     'json': False,
     'post_encoding': False,
+    'rate_limit': None,
+    'rate_limit_key': 'ip',
     'ssl': SSL_ONLY,
     'xsrf': False
     }
@@ -291,6 +571,893 @@ def handle(name, renderers=[], **config):
         return function
     return __register_handler
 
+# ------------------------------------------------------------------------------
+# Local Memcache
+# ------------------------------------------------------------------------------
+
+_time = time
+
+# The ``LocalMemcache`` is an in-process stand-in for the subset of the App
+# Engine memcache API that weblite uses for its shared state. Expired items are
+# swept every ``sweep_interval`` seconds, and like memcache, the least recently
+# written items are evicted once it holds ``max_items``.
+class LocalMemcache(object):
+
+    max_items = 10000
+    sweep_interval = 60
+
+    def __init__(self):
+        self._data = OrderedDict()
+        self._lock = Lock()
+        self._next_sweep = _time() + self.sweep_interval
+
+    def _get(self, key, namespace, now):
+        item = self._data.get((namespace, key))
+        if item is None:
+            return
+        if item[1] and item[1] <= now:
+            del self._data[(namespace, key)]
+            return
+        return item
+
+    def get(self, key, namespace=None):
+        with self._lock:
+            item = self._get(key, namespace, time())
+        if item:
+            return item[0]
+
+    def set(self, key, value, time=0, namespace=None):
+        with self._lock:
+            self._put((namespace, key), value, self._expiry(time))
+        return True
+
+    def add(self, key, value, time=0, namespace=None):
+        with self._lock:
+            if self._get(key, namespace, _time()):
+                return False
+            self._put((namespace, key), value, self._expiry(time))
+        return True
+
+    def delete(self, key, namespace=None):
+        with self._lock:
+            return self._data.pop((namespace, key), None) and 2 or 1
+
+    def incr(self, key, delta=1, namespace=None, initial_value=None):
+        with self._lock:
+            item = self._get(key, namespace, time())
+            if item is None:
+                if initial_value is None:
+                    return
+                item = (initial_value, 0)
+            value = item[0] + delta
+            self._put((namespace, key), value, item[1])
+        return value
+
+    def flush_all(self):
+        with self._lock:
+            self._data.clear()
+        return True
+
+    # Called with the lock held.
+    def _put(self, key, value, expiry):
+        data = self._data
+        data.pop(key, None)
+        data[key] = (value, expiry)
+        if len(data) > self.max_items:
+            data.popitem(last=False)
+        now = _time()
+        if now >= self._next_sweep:
+            self._next_sweep = now + self.sweep_interval
+            for item_key, item in data.items():
+                if item[1] and item[1] <= now:
+                    del data[item_key]
+
+    # Like memcache, treat durations over 30 days as absolute timestamps.
+    def _expiry(self, duration):
+        if not duration:
+            return 0
+        if duration > 2592000:
+            return duration
+        return _time() + duration
+
+# ------------------------------------------------------------------------------
+# Admission Control
+# ------------------------------------------------------------------------------
+
+# The ``AdmissionController`` sheds requests after routing and before the
+# handler is called. Handlers opt in with their config:
+#
+#   rate_limit      (rate, burst) -- a token bucket refilled at ``rate`` per
+#                   second and holding at most ``burst`` tokens
+#   rate_limit_key  what the bucket is keyed on: 'ip', 'user' or 'handler'
+#   concurrency     the max number of in-flight requests for the handler
+#
+# Rate limited requests get a 429 and over capacity ones get a 503, both with a
+# ``Retry-After`` header. If ``shared`` is set to a memcache-like client, rate
+# limits are additionally enforced across instances with per-window counters.
+class AdmissionController(object):
+
+    max_buckets = 10000
+    shared_namespace = 'weblite.admission'
+    shared_window = 10
+
+    def __init__(self, shared=None):
+        self.shared = shared
+        self._buckets = {}
+        self._active = {}
+        self._lock = Lock()
+        self._stats = {}
+
+    def admit(self, ctx, name, config):
+        rate_limit = config['rate_limit']
+        concurrency = config['concurrency']
+        if not (rate_limit or concurrency):
+            return
+        if rate_limit:
+            kind = config['rate_limit_key']
+            if kind == 'user':
+                key = ctx.user_id or ctx.environ.get('REMOTE_ADDR', '')
+            elif kind == 'handler':
+                key = ''
+            else:
+                key = ctx.environ.get('REMOTE_ADDR', '')
+            retry_after = self._take_token(name, key, rate_limit)
+            if retry_after:
+                self._count(name, 'rate_limited')
+                raise Overloaded(STATUS_429, retry_after)
+        if concurrency:
+            with self._lock:
+                active = self._active.get(name, 0)
+                if active < concurrency:
+                    self._active[name] = active + 1
+                    admitted = 1
+                else:
+                    admitted = 0
+            if not admitted:
+                self._count(name, 'concurrency_limited')
+                raise Overloaded(STATUS_503, 1)
+        self._count(name, 'admitted')
+        return bool(concurrency)
+
+    def release(self, name):
+        with self._lock:
+            self._active[name] -= 1
+
+    # Return 0 if a token was available, or the number of seconds to wait.
+    def _take_token(self, name, key, rate_limit):
+        rate, burst = rate_limit
+        now = time()
+        bucket_key = (name, key)
+        with self._lock:
+            bucket = self._buckets.get(bucket_key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_buckets:
+                    self._prune(now)
+                tokens = burst
+            else:
+                tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            if tokens < 1:
+                self._buckets[bucket_key] = (tokens, now)
+                return int((1 - tokens) / rate) + 1
+            self._buckets[bucket_key] = (tokens - 1, now)
+        shared = self.shared
+        if shared is not None:
+            window = self.shared_window
+            period = int(now / window)
+            counter = 'rate:%s:%s:%d' % (name, key, period)
+            # Create the counter with an expiry, as ``incr`` can't set one.
+            shared.add(
+                counter, 0, time=window * 2, namespace=self.shared_namespace
+                )
+            count = shared.incr(counter, namespace=self.shared_namespace)
+            # Fail open if the shared tier is unavailable.
+            if count is not None and count > (rate * window) + burst:
+                return int((period + 1) * window - now) + 1
+        return 0
+
+    # Drop buckets that haven't been touched for a minute. Called with the lock
+    # held.
+    def _prune(self, now):
+        buckets = self._buckets
+        for key, (tokens, last) in buckets.items():
+            if now - last > 60:
+                del buckets[key]
+        if len(buckets) >= self.max_buckets:
+            buckets.clear()
+
+    def _count(self, name, outcome):
+        with self._lock:
+            stats = self._stats.setdefault(name, {
+                'admitted': 0, 'concurrency_limited': 0, 'rate_limited': 0
+                })
+            stats[outcome] += 1
+
+    def get_stats(self):
+        with self._lock:
+            return dict(
+                (name, stats.copy()) for name, stats in self._stats.iteritems()
+                )
+
+# ------------------------------------------------------------------------------
+# Session Cache
+# ------------------------------------------------------------------------------
+
+try:
+    from config import SESSION_CACHE
+except ImportError:
+    SESSION_CACHE = False
+
+try:
+    from config import SESSION_COOKIE
+except ImportError:
+    SESSION_COOKIE = 'session'
+
+_missing = object()
+
+# The ``SessionCache`` memoises the ``user``, ``user_id`` and ``is_admin``
+# lookups across requests, keyed on a hash of the verified session token. It's
+# only enabled if ``SESSION_CACHE`` is set in the config. Values are kept in an
+# in-process LRU for ``ttl`` seconds, and in the ``shared`` memcache-like tier,
+# if set, for ``shared_ttl`` seconds. Cached values are shared between requests
+# and must be treated as read-only.
+#
+# On logout, ``invalidate`` drops a token. On permission changes,
+# ``invalidate_user`` drops all the tokens seen for a user. Entries held in the
+# LRUs of other instances or processes expire within ``ttl``. The shared tier
+# must therefore be visible to every process, e.g. App Engine's memcache, which
+# is used on Google's servers. Elsewhere it's left unset.
+class SessionCache(object):
+
+    max_tokens_per_user = 50
+    shared_namespace = 'weblite.session'
+
+    def __init__(self, shared=None, size=1000, ttl=10, shared_ttl=300):
+        self.shared = shared
+        self.size = size
+        self.ttl = ttl
+        self.shared_ttl = shared_ttl
+        self._entries = OrderedDict()
+        self._by_user = {}
+        self._lock = Lock()
+        self._stats = {}
+
+    def get(self, token, field, resolve, user_id=None):
+        key = sha1(token).hexdigest()
+        now = time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries[key] = entry
+                    value = entry[1].get(field, _missing)
+                    if value is not _missing:
+                        self._count(field, 'local', locked=True)
+                        return value
+                else:
+                    self._remove_from_index(key, entry[2])
+        values = {}
+        shared = self.shared
+        if shared is not None:
+            values = shared.get(key, namespace=self.shared_namespace) or {}
+            value = values.get(field, _missing)
+            if value is not _missing:
+                self._store(key, values, user_id or values.get('user_id'), now)
+                self._count(field, 'shared')
+                return value
+        value = resolve()
+        values = dict(values)
+        values[field] = value
+        if field == 'user_id':
+            user_id = value
+        values = self._store(key, values, user_id, now)
+        if shared is not None:
+            shared.set(
+                key, values, time=self.shared_ttl,
+                namespace=self.shared_namespace
+                )
+            if user_id:
+                self._index_shared(key, user_id)
+        self._count(field, 'miss')
+        return value
+
+    def invalidate(self, token):
+        key = sha1(token).hexdigest()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._remove_from_index(key, entry[2])
+        if self.shared is not None:
+            self.shared.delete(key, namespace=self.shared_namespace)
+        self._count('*', 'invalidated')
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            keys = self._by_user.pop(user_id, set())
+            for key in keys:
+                self._entries.pop(key, None)
+        shared = self.shared
+        if shared is not None:
+            index_key = 'user:%s' % user_id
+            keys = keys.union(
+                shared.get(index_key, namespace=self.shared_namespace) or ()
+                )
+            for key in keys:
+                shared.delete(key, namespace=self.shared_namespace)
+            shared.delete(index_key, namespace=self.shared_namespace)
+        self._count('*', 'invalidated', len(keys))
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(
+                (field, counts.copy())
+                for field, counts in self._stats.iteritems()
+                )
+            stats['*'] = counts = stats.get('*', {})
+            counts['entries'] = len(self._entries)
+        for field, counts in stats.iteritems():
+            if field == '*':
+                continue
+            hits = counts.get('local', 0) + counts.get('shared', 0)
+            total = hits + counts.get('miss', 0)
+            counts['hit_rate'] = total and hits / float(total) or 0.0
+        return stats
+
+    # Merge the ``values`` into any live entry for the token, keeping its
+    # expiry, and return the merged values.
+    def _store(self, key, values, user_id, now):
+        expires = now + self.ttl
+        with self._lock:
+            entries = self._entries
+            entry = entries.pop(key, None)
+            if entry is not None:
+                self._remove_from_index(key, entry[2])
+                if entry[0] > now:
+                    expires = entry[0]
+                    values = dict(entry[1], **values)
+                    user_id = user_id or entry[2]
+            entries[key] = (expires, values, user_id)
+            if user_id:
+                self._by_user.setdefault(user_id, set()).add(key)
+            while len(entries) > self.size:
+                old_key, old_entry = entries.popitem(last=False)
+                self._remove_from_index(old_key, old_entry[2])
+                self._count('*', 'evicted', locked=True)
+        return values
+
+    # Record the token under the user's index in the shared tier, so that
+    # ``invalidate_user`` can find the tokens cached by other instances.
+    def _index_shared(self, key, user_id):
+        shared = self.shared
+        index_key = 'user:%s' % user_id
+        keys = shared.get(index_key, namespace=self.shared_namespace) or []
+        if key in keys:
+            return
+        keys = keys[-(self.max_tokens_per_user - 1):] + [key]
+        shared.set(
+            index_key, keys, time=self.shared_ttl,
+            namespace=self.shared_namespace
+            )
+
+    # Called with the lock held.
+    def _remove_from_index(self, key, user_id):
+        if not user_id:
+            return
+        keys = self._by_user.get(user_id)
+        if keys:
+            keys.discard(key)
+            if not keys:
+                del self._by_user[user_id]
+
+    def _count(self, field, outcome, n=1, locked=False):
+        if locked:
+            counts = self._stats.setdefault(field, {})
+            counts[outcome] = counts.get(outcome, 0) + n
+            return
+        with self._lock:
+            self._count(field, outcome, n, True)
+
+# ------------------------------------------------------------------------------
+# Access Log
+# ------------------------------------------------------------------------------
+
+# The ``AccessLog`` buffers a structured record for each request and flushes
+# them in batches from a background thread. Where threads can't outlive the
+# request, i.e. on App Engine, records are flushed inline once ``batch_size``
+# have been buffered and at the end of each request.
+#
+# Records are sampled by status class, e.g. ``sample_rates[4] = 0.01`` keeps 1%
+# of 4xx responses. Tracebacks are grouped by the exception type and the code
+# locations in the traceback, and each group is logged at most once every
+# ``traceback_interval`` seconds.
+#
+# The ``timings`` of a record are the milliseconds elapsed since the start of
+# the request at the end of each phase, i.e. ``route``, ``body``, ``auth``,
+# ``handler``, ``render`` and ``total``. The ``cache`` field is whatever the
+# handler set ``ctx.cache_outcome`` to, e.g. 'hit' or 'miss'.
+class AccessLog(object):
+
+    background = BACKGROUND_THREADS
+    batch_size = 100
+    enabled = True
+    flush_interval = 5.0
+    max_buffer = 10000
+    traceback_interval = 60
+
+    logger = logging.getLogger('weblite.access')
+
+    def __init__(self, sample_rates=None):
+        self.sample_rates = {2: 1.0, 3: 1.0, 4: 1.0, 5: 1.0}
+        if sample_rates:
+            self.sample_rates.update(sample_rates)
+        self.dropped = 0
+        self._buffer = deque()
+        self._flush_lock = Lock()
+        self._lock = Lock()
+        self._thread = None
+        self._tracebacks = {}
+        self._wakeup = Event()
+
+    def submit(self, record):
+        rate = self.sample_rates.get(record['status'] // 100, 1.0)
+        if rate < 1.0 and random() >= rate:
+            return
+        buffer = self._buffer
+        if len(buffer) >= self.max_buffer:
+            self.dropped += 1
+            return
+        buffer.append(record)
+        if self._thread is None and self.background:
+            self._start_thread()
+        if len(buffer) >= self.batch_size:
+            if self._thread:
+                self._wakeup.set()
+            else:
+                self.flush()
+
+    def end_request(self):
+        if not self._thread and self._buffer:
+            self.flush()
+
+    def _start_thread(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            try:
+                thread = Thread(target=self._run, name='weblite.access')
+                thread.daemon = True
+                thread.start()
+                atexit.register(self.flush)
+            except Exception:
+                thread = False
+            self._thread = thread
+
+    def _run(self):
+        while 1:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("Couldn't flush the access log")
+
+    def flush(self):
+        with self._flush_lock:
+            buffer = self._buffer
+            batch = []
+            while buffer:
+                batch.append(buffer.popleft())
+            if self.dropped:
+                with self._lock:
+                    dropped, self.dropped = self.dropped, 0
+                logging.warning("Dropped %d access log records" % dropped)
+            if batch:
+                self.emit(batch)
+
+    def emit(self, records):
+        self.logger.info('\n'.join(encode_json(record) for record in records))
+
+    def log_exception(self, exc_info):
+        exc_type, exc_value, tb = exc_info
+        locations = []
+        while tb is not None:
+            locations.append((tb.tb_frame.f_code.co_filename, tb.tb_lineno))
+            tb = tb.tb_next
+        key = (exc_type, tuple(locations))
+        now = time()
+        with self._lock:
+            last, suppressed = self._tracebacks.get(key, (0, 0))
+            if now - last < self.traceback_interval:
+                self._tracebacks[key] = (last, suppressed + 1)
+                return False
+            if len(self._tracebacks) >= 1000:
+                self._tracebacks.clear()
+            self._tracebacks[key] = (now, 0)
+        message = ''.join(format_exception(*exc_info))
+        if suppressed:
+            message += "(%d similar tracebacks suppressed)" % suppressed
+        logging.critical(message)
+        return True
+
+# ------------------------------------------------------------------------------
+# Memory Profiling
+# ------------------------------------------------------------------------------
+
+try:
+    from config import MEMORY_PROFILE_RATE
+except ImportError:
+    MEMORY_PROFILE_RATE = 0
+
+# The memory profile handler is only registered if ``MEMORY_PROFILE_HANDLER``
+# is set in the config, e.g. to ``'__memory__'``.
+try:
+    from config import MEMORY_PROFILE_HANDLER
+except ImportError:
+    MEMORY_PROFILE_HANDLER = None
+
+# A ``MemorySample`` measures the net and peak allocations made between its
+# creation and ``finish``. Nested samples, e.g. for templates rendered within a
+# request, fold their peak into that of their parent.
+#
+# Peaks are only measured where ``tracemalloc.reset_peak`` is available. Both
+# measures are process-wide, so they are approximate when sampled requests are
+# served concurrently.
+class MemorySample(object):
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        if parent is not None:
+            parent.checkpoint()
+        reset_peak = getattr(tracemalloc, 'reset_peak', None)
+        if reset_peak:
+            reset_peak()
+            self.track_peak = True
+        else:
+            self.track_peak = False
+        self.start = self.peak = tracemalloc.get_traced_memory()[0]
+
+    def checkpoint(self):
+        self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+
+    def finish(self):
+        current, peak = tracemalloc.get_traced_memory()
+        if self.track_peak:
+            peak = max(self.peak, peak)
+        else:
+            peak = max(self.peak, current)
+        if self.parent is not None:
+            self.parent.peak = max(self.parent.peak, peak)
+        return current - self.start, peak - self.start
+
+# The ``MemoryProfiler`` records the allocations of a ``sample_rate`` share of
+# requests with ``tracemalloc``, aggregated per handler and per template. The
+# stats, along with the largest live allocation sites, are served as JSON by an
+# admin-only handler and can be dumped to a file. If ``dump_path`` is set, they
+# are also dumped after every ``dump_interval`` samples.
+#
+# Tracing is started with the first sample and left on, as the live allocation
+# sites need it and requests may be sampled concurrently. From then on every
+# allocation in the process is traced, so the ``sample_rate`` only reduces the
+# bookkeeping, not the overhead of ``tracemalloc`` itself.
+class MemoryProfiler(object):
+
+    dump_interval = 1000
+    dump_path = None
+    frames = 1
+    top_sites = 20
+
+    def __init__(self, sample_rate=0):
+        self.sample_rate = sample_rate
+        self.samples = 0
+        self._handlers = {}
+        self._lock = Lock()
+        self._templates = {}
+
+    def begin(self):
+        rate = self.sample_rate
+        if not rate or tracemalloc is None:
+            return
+        if rate < 1 and random() >= rate:
+            return
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        return MemorySample()
+
+    def record(self, name, sample):
+        self._record(self._handlers, name, sample)
+        with self._lock:
+            self.samples += 1
+            dump = self.dump_path and not (self.samples % self.dump_interval)
+        if dump:
+            self.dump()
+
+    def record_template(self, uri, sample):
+        self._record(self._templates, uri, sample)
+
+    def _record(self, stats, key, sample):
+        net, peak = sample.finish()
+        with self._lock:
+            entry = stats.get(key)
+            if entry is None:
+                entry = stats[key] = {
+                    'count': 0, 'net': 0, 'net_max': 0, 'peak': 0, 'peak_max': 0
+                    }
+            entry['count'] += 1
+            entry['net'] += net
+            entry['peak'] += peak
+            if net > entry['net_max']:
+                entry['net_max'] = net
+            if peak > entry['peak_max']:
+                entry['peak_max'] = peak
+
+    def get_top_sites(self, limit=None):
+        if tracemalloc is None or not tracemalloc.is_tracing():
+            return []
+        stats = tracemalloc.take_snapshot().statistics('lineno')
+        return [{
+            'site': str(stat.traceback),
+            'size': stat.size,
+            'count': stat.count
+            } for stat in stats[:limit or self.top_sites]]
+
+    def get_stats(self):
+        with self._lock:
+            handlers = dict((k, v.copy()) for k, v in self._handlers.iteritems())
+            templates = dict((k, v.copy()) for k, v in self._templates.iteritems())
+            samples = self.samples
+        return {
+            'available': tracemalloc is not None,
+            'handlers': handlers,
+            'sample_rate': self.sample_rate,
+            'samples': samples,
+            'sites': self.get_top_sites(),
+            'templates': templates
+            }
+
+    def dump(self, path=None):
+        f = open(path or self.dump_path, 'wb')
+        f.write(encode_json(self.get_stats(), indent=2, sort_keys=True))
+        f.close()
+
+    def reset(self):
+        with self._lock:
+            self.samples = 0
+            self._handlers.clear()
+            self._templates.clear()
+
+# ------------------------------------------------------------------------------
+# Deferred Work
+# ------------------------------------------------------------------------------
+
+DEFERRED_TASKS = {}
+DEFERRED_TASK_NAMES = {}
+
+# The ``deferred_task`` decorator registers a function under a name, so that
+# calls to it which can't be run in-process can be spilled to a task queue.
+def deferred_task(name):
+    def __register_task(function):
+        DEFERRED_TASKS[name] = function
+        DEFERRED_TASK_NAMES[function] = name
+        return function
+    return __register_task
+
+def run_deferred_task(name, payload):
+    payload = json_decode(payload)
+    return DEFERRED_TASKS[name](*payload['args'], **dict(
+        (str(key), value) for key, value in payload['kwargs'].iteritems()
+        ))
+
+# The ``AppEngineTaskQueue`` spills tasks to App Engine's push queues. They are
+# targeted at the current version of the current module, where they're run by
+# ``DeferredQueue.handle_task``.
+class AppEngineTaskQueue(object):
+
+    def __init__(self, queue_name='default'):
+        self.queue_name = queue_name
+
+    def add(self, url, payload):
+        from google.appengine.api import modules, taskqueue
+        target = '%s.%s' % (
+            modules.get_current_version_name(),
+            modules.get_current_module_name()
+            )
+        taskqueue.Queue(self.queue_name).add(taskqueue.Task(
+            url=url, payload=payload, method='POST', target=target
+            ))
+
+# The ``LocalTaskQueue`` is a stand-in for the task queue which persists tasks
+# as lines of JSON in a local file. The ``DeferredQueue`` workers ``drain`` it
+# whenever they're idle. The file is renamed before it's read, so that each
+# task is only claimed by one process.
+class LocalTaskQueue(object):
+
+    def __init__(self, path='.deferred.json'):
+        self.path = path
+        self._lock = Lock()
+
+    def add(self, url, payload):
+        line = encode_json({'url': url, 'payload': payload, 'eta': time()})
+        with self._lock:
+            f = open(self.path, 'ab')
+            f.write(line + '\n')
+            f.close()
+
+    def drain(self, prefix):
+        claimed = '%s.%d' % (self.path, os.getpid())
+        with self._lock:
+            try:
+                os.rename(self.path, claimed)
+            except OSError:
+                return 0
+        f = open(claimed, 'rb')
+        lines = f.readlines()
+        f.close()
+        os.remove(claimed)
+        count = 0
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                task = json_decode(line)
+                url = task['url']
+                payload = task['payload']
+            except (KeyError, TypeError, ValueError):
+                logging.error("Skipping malformed deferred task: %r" % line)
+                continue
+            try:
+                run_deferred_task(url[len(prefix):], payload)
+            except Exception:
+                logging.exception("Couldn't run deferred task %s" % url)
+            count += 1
+        return count
+
+# The ``DeferredQueue`` runs the work that handlers pass to ``ctx.defer`` once
+# the response has been handed over to the WSGI server. Jobs are run on a pool
+# of ``workers`` threads, with at most ``max_pending`` of them waiting.
+#
+# When the pool is full, or where threads can't outlive the request, jobs for
+# functions registered with ``deferred_task`` are spilled to the ``spill``
+# queue as a POST to ``/_deferred/<name>``. Any other jobs are run inline.
+# Errors in jobs are logged and counted, but never affect other jobs.
+#
+# On App Engine there is no pool, and the runtime only sends the response once
+# it has been closed. So jobs that aren't registered with ``deferred_task`` are
+# run inline before the response is flushed, and still delay it.
+class DeferredQueue(object):
+
+    drain_interval = 5.0
+    max_pending = 1000
+    max_per_request = 20
+    task_prefix = '/_deferred/'
+
+    def __init__(self, workers=4, spill=None):
+        self.workers = workers
+        self.spill = spill
+        self._lock = Lock()
+        self._queue = Queue(self.max_pending)
+        self._started = False
+        self._stats = {
+            'completed': 0, 'failed': 0, 'inline': 0, 'queued': 0,
+            'rejected': 0, 'spilled': 0
+            }
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self._stats[key] += n
+
+    def _start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        for idx in range(self.workers):
+            thread = Thread(target=self._work, name='weblite.deferred.%d' % idx)
+            thread.daemon = True
+            thread.start()
+
+    def _work(self):
+        drain = getattr(self.spill, 'drain', None)
+        while 1:
+            try:
+                job = self._queue.get(timeout=self.drain_interval)
+            except Empty:
+                if drain:
+                    try:
+                        drain(self.task_prefix)
+                    except Exception:
+                        handle_http_request.access_log.log_exception(
+                            sys.exc_info()
+                            )
+                continue
+            self.run(*job)
+
+    # Run a task that was spilled to App Engine's push queue. The route only
+    # exists on Google's servers, where ``module.yaml`` restricts it to admins
+    # and the ``X-AppEngine-TaskName`` header is stripped from external
+    # requests. Failed tasks get a 500, so that the queue retries them.
+    def handle_task(self, env, start_response):
+        name = env['PATH_INFO'][len(self.task_prefix):]
+        if not (
+            RUNNING_ON_GOOGLE_SERVERS and
+            isinstance(self.spill, AppEngineTaskQueue) and
+            env['REQUEST_METHOD'] == 'POST' and
+            'HTTP_X_APPENGINE_TASKNAME' in env and name in DEFERRED_TASKS
+            ):
+            start_response(*RESPONSE_404)
+            return [ERROR_404]
+        payload = env['wsgi.input'].read(int(env.get('CONTENT_LENGTH') or 0))
+        try:
+            run_deferred_task(name, payload)
+        except Exception:
+            self._count('failed')
+            handle_http_request.access_log.log_exception(sys.exc_info())
+            start_response(*RESPONSE_500)
+            return [ERROR_500]
+        self._count('completed')
+        start_response('200 OK', [('Content-Type', 'text/plain; charset=utf-8')])
+        return ['OK']
+
+    def run(self, function, args, kwargs):
+        try:
+            function(*args, **kwargs)
+        except Exception:
+            self._count('failed')
+            handle_http_request.access_log.log_exception(sys.exc_info())
+        else:
+            self._count('completed')
+
+    def submit(self, jobs):
+        if self.workers and not self._started:
+            self._start()
+        for job in jobs:
+            if self.workers:
+                try:
+                    self._queue.put_nowait(job)
+                except Full:
+                    pass
+                else:
+                    self._count('queued')
+                    continue
+            name = DEFERRED_TASK_NAMES.get(job[0])
+            if name and self.spill is not None:
+                try:
+                    self.spill.add(self.task_prefix + name, encode_json({
+                        'args': job[1], 'kwargs': job[2]
+                        }))
+                except Exception:
+                    logging.exception("Couldn't spill deferred task %s" % name)
+                else:
+                    self._count('spilled')
+                    continue
+            self._count('inline')
+            self.run(*job)
+
+    def get_stats(self):
+        with self._lock:
+            stats = self._stats.copy()
+        stats['pending'] = self._queue.qsize()
+        return stats
+
+# The ``DeferredResponse`` wraps a response and submits the deferred jobs once
+# the WSGI server closes it. Most servers have sent the body by then, but App
+# Engine only flushes it after ``close`` returns.
+class DeferredResponse(object):
+
+    def __init__(self, response, jobs, queue):
+        self.response = response
+        self.jobs = jobs
+        self.queue = queue
+
+    def __iter__(self):
+        return iter(self.response)
+
+    def __len__(self):
+        return len(self.response)
+
+    def close(self):
+        jobs, self.jobs = self.jobs, None
+        if jobs:
+            self.queue.submit(jobs)
+
 # ------------------------------------------------------------------------------
 # HTTP Utilities
 # ------------------------------------------------------------------------------
@@ -304,10 +1471,187 @@ def get_http_datetime(timestamp=None):
         timestamp = datetime.utcnow()
     return timestamp.strftime('%a, %d %B %Y %H:%M:%S GMT') # %m
 
+# ------------------------------------------------------------------------------
+# URL Building
+# ------------------------------------------------------------------------------
+
+# The encoded path segments, quoted query keys/values and URL prefixes are
+# memoised in bounded caches. Long values, e.g. ``return_to`` URLs, are rarely
+# repeated and so aren't cached.
+URL_CACHE_SIZE = 10000
+URL_CACHE_MAX_VALUE_LENGTH = 256
+
+def _cached(func, cache, limit=URL_CACHE_SIZE, max=URL_CACHE_MAX_VALUE_LENGTH):
+    def __cached(value):
+        try:
+            return cache[value]
+        except KeyError:
+            pass
+        result = func(value)
+        if len(value) <= max:
+            if len(cache) >= limit:
+                cache.clear()
+            cache[value] = result
+        return result
+    __cached.cache = cache
+    return __cached
+
+encode_url_segment = _cached(lambda arg: arg.encode('utf-8'), {})
+quote_url_key = _cached(lambda key: urlquote(key).replace(' ', '+'), {})
+quote_url_value = _cached(
+    lambda value: urlquote(value.encode('utf-8')).replace(' ', '+'), {}
+    )
+
+def get_url_prefix(
+    scheme, host, args, cache={}, limit=URL_CACHE_SIZE,
+    segment=encode_url_segment
+    ):
+    key = (scheme, host, args)
+    try:
+        return cache[key]
+    except KeyError:
+        pass
+    prefix = ''.join([
+        scheme, '://', host, '/', '/'.join([segment(arg) for arg in args])
+        ])
+    if len(cache) >= limit:
+        cache.clear()
+    cache[key] = prefix
+    return prefix
+
+def build_url(prefix, kwargs, key=quote_url_key, value=quote_url_value):
+    if not kwargs:
+        return prefix
+    out = [prefix, '?']; add = out.append
+    for name, val in kwargs.items():
+        name = key(name)
+        if val is None:
+            val = ''
+        if isinstance(val, list):
+            for item in val:
+                if len(out) > 2:
+                    add('&')
+                add(name); add('='); add(value(item))
+        else:
+            if len(out) > 2:
+                add('&')
+            add(name); add('='); add(value(val))
+    return ''.join(out)
+
+# The ``URLTemplate`` precomputes the prefix of URLs which share their leading
+# path segments, e.g. ``ctx.compute_url_template('item')``, so that only the
+# remaining segments and query parameters are built per call.
+class URLTemplate(object):
+
+    def __init__(self, prefix, base):
+        self.prefix = prefix
+        self._base = base
+
+    def __call__(self, *args, **kwargs):
+        if args:
+            prefix = self._base + '/'.join([
+                encode_url_segment(arg) for arg in args
+                ])
+        else:
+            prefix = self.prefix
+        return build_url(prefix, kwargs)
+
+    # Return a URL for each item, where an item is either a single path
+    # segment or a tuple of them. The ``kwargs`` are added to every URL.
+    def build_many(self, items, **kwargs):
+        base = self._base
+        if kwargs:
+            query = build_url('', kwargs)
+        else:
+            query = ''
+        urls = []; add = urls.append
+        for item in items:
+            if isinstance(item, tuple):
+                if not item:
+                    add(self.prefix + query)
+                    continue
+                add(''.join([
+                    base, '/'.join([encode_url_segment(arg) for arg in item]),
+                    query
+                    ]))
+            else:
+                add(''.join([base, encode_url_segment(item), query]))
+        return urls
+
+def get_url_template(scheme, host, args, cache={}, limit=URL_CACHE_SIZE):
+    key = (scheme, host, args)
+    try:
+        return cache[key]
+    except KeyError:
+        pass
+    prefix = get_url_prefix(scheme, host, args)
+    if args:
+        template = URLTemplate(prefix, prefix + '/')
+    else:
+        template = URLTemplate(prefix, prefix)
+    if len(cache) >= limit:
+        cache.clear()
+    cache[key] = template
+    return template
+
+# ------------------------------------------------------------------------------
+# Uploads
+# ------------------------------------------------------------------------------
+
+# The ``MediaTypeSniffer`` wraps the file that an upload is spooled to and keeps
+# hold of the leading bytes as they are written.
+class MediaTypeSniffer(object):
+
+    def __init__(self, file, limit):
+        self._file = file
+        self._limit = limit
+        self.head = ''
+
+    def write(self, data):
+        if len(self.head) < self._limit:
+            self.head += data[:self._limit - len(self.head)]
+        self._file.write(data)
+
+    def __getattr__(self, attr):
+        return getattr(self._file, attr)
+
+    def __iter__(self):
+        return iter(self._file)
+
+# The ``UploadFieldStorage`` exposes the sniffed ``media_type`` of uploaded
+# files, so that handlers don't have to trust the client's Content-Type.
+class UploadFieldStorage(FieldStorage):
+
+    detector = media_type_detector
+
+    def make_file(self, binary=None):
+        return MediaTypeSniffer(
+            FieldStorage.make_file(self, binary), self.detector.sniff_length
+            )
+
+    @property
+    def media_type(self):
+        if not hasattr(self, '_media_type'):
+            file = self.file
+            if isinstance(file, MediaTypeSniffer):
+                head = file.head
+            elif hasattr(file, 'getvalue'):
+                # Small uploads are kept in memory and never hit ``make_file``.
+                head = file.getvalue()[:self.detector.sniff_length]
+            else:
+                head = ''
+            self._media_type = self.detector.detect(head)
+        return self._media_type
+
 # ------------------------------------------------------------------------------
 # Context
 # ------------------------------------------------------------------------------
 
+FORKED_CONTEXT_ATTRIBUTES = (
+    '_cookies_parsed', '_is_admin', '_request_cookies', '_session_token',
+    '_user', '_user_id', '_xsrf_token', 'ajax_request', 'site_host'
+    )
+
 # The ``Context`` class encompasses the HTTP request/response. An instance,
 # specific to the current request, is passed in as the first parameter to all
 # handlers.
@@ -323,11 +1667,14 @@ class Context(object):
     urlunquote = staticmethod(urlunquote)
 
     ajax_request = None
+    cache_outcome = None
     json_callback = None
     end_pipeline = None
     site_host = None
 
     _cookies_parsed = None
+    _deferred = None
+    _preloaded = None
     _xsrf_token = None
 
     def __init__(self, environ, ssl_mode):
@@ -343,6 +1690,49 @@ class Context(object):
         else:
             self.scheme = 'http'
 
+    # Return a context for a sub-request, which shares the parsed request
+    # cookies and any already resolved user, admin and XSRF state.
+    def fork(self):
+        ctx = Context(self.environ, self.ssl_mode)
+        attrs = self.__dict__
+        for attr in FORKED_CONTEXT_ATTRIBUTES:
+            if attr in attrs:
+                setattr(ctx, attr, attrs[attr])
+        return ctx
+
+    # Add ``Link: rel=preload`` response headers for the assets of the given
+    # template, skipping any that have already been added, and return them.
+    def preload_template_assets(self, uri):
+        names = PRELOAD_ASSETS.get(uri)
+        if not names:
+            return []
+        if self._preloaded is None:
+            self._preloaded = set()
+        links = []
+        for name in names:
+            if name in self._preloaded:
+                continue
+            self._preloaded.add(name)
+            link = get_preload_link(self, name)
+            self.response_headers.add_header('Link', link)
+            links.append(link)
+        return links
+
+    # Run ``function`` once the response has been sent. Returns False if the
+    # request has already deferred the maximum number of jobs. On App Engine,
+    # only functions registered with ``deferred_task`` are run after the
+    # response. Others are run inline before it is flushed.
+    def defer(self, function, *args, **kwargs):
+        if self._deferred is None:
+            self._deferred = []
+        queue = handle_http_request.deferred
+        if len(self._deferred) >= queue.max_per_request:
+            queue._count('rejected')
+            logging.warning("Too many deferred jobs for: %s" % self.url)
+            return False
+        self._deferred.append((function, args, kwargs))
+        return True
+
     def set_response_status(self, code, message=None):
         if not message:
             message = HTTP_STATUS_MESSAGES.get(code, ["Server Error"])[0]
@@ -419,39 +1809,30 @@ class Context(object):
         return self.compute_url_for_host(self.site_host or self.host, *args, **kwargs)
 
     def compute_url_for_host(self, host, *args, **kwargs):
-        out = self.scheme + '://' + host + '/' + '/'.join(
-            arg.encode('utf-8') for arg in args
+        return build_url(get_url_prefix(self.scheme, host, args), kwargs)
+
+    def compute_url_template(self, *args):
+        return self.compute_url_template_for_host(
+            self.site_host or self.host, *args
             )
-        if kwargs:
-            out += '?'
-            _set = 0
-            _l = ''
-            for key, value in kwargs.items():
-                key = urlquote(key).replace(' ', '+')
-                if value is None:
-                    value = ''
-                if isinstance(value, list):
-                    for val in value:
-                        if _set: _l = '&'
-                        out += '%s%s=%s' % (
-                            _l, key,
-                            urlquote(val.encode('utf-8')).replace(' ', '+')
-                            )
-                        _set = 1
-                else:
-                    if _set: _l = '&'
-                    out += '%s%s=%s' % (
-                        _l, key, urlquote(value.encode('utf-8')).replace(' ', '+')
-                        )
-                    _set = 1
-        return out
+
+    def compute_url_template_for_host(self, host, *args):
+        return get_url_template(self.scheme, host, args)
 
     @property
     def is_admin(self):
         if not hasattr(self, '_is_admin'):
-            self._is_admin = self.get_admin_status()
+            self._is_admin = self._get_session_value(
+                'is_admin', self.get_admin_status
+                )
         return self._is_admin
 
+    @property
+    def session_token(self):
+        if not hasattr(self, '_session_token'):
+            self._session_token = self.get_session_token()
+        return self._session_token
+
     @property
     def site_url(self):
         if not hasattr(self, '_site_url'):
@@ -478,18 +1859,42 @@ class Context(object):
                 )
         return self._url_with_qs
 
+    # If ``SESSION_CACHE`` is enabled, the same user object is returned to
+    # concurrent requests, so it must be treated as read-only. Load a fresh copy
+    # of the user before changing it.
     @property
     def user(self):
         if not hasattr(self, '_user'):
-            self._user = self.get_user()
+            self._user = self._get_session_value('user', self.get_user)
         return self._user
 
     @property
     def user_id(self):
         if not hasattr(self, '_user_id'):
-            self._user_id = self.get_user_id()
+            self._user_id = self._get_session_value('user_id', self.get_user_id)
         return self._user_id
 
+    # Resolve a session ``field`` through the session cache. Anonymous requests
+    # and sessions without a user id go straight to the login module.
+    def _get_session_value(self, field, resolve):
+        cache = handle_http_request.session_cache
+        if cache is None or not self.session_token:
+            return resolve()
+        user_id = None
+        if field != 'user_id':
+            user_id = self.user_id
+            if not user_id:
+                return resolve()
+        return cache.get(self.session_token, field, resolve, user_id)
+
+    # Drop the cached user state for the current session, e.g. on logout.
+    def invalidate_session(self):
+        cache = handle_http_request.session_cache
+        if cache is not None and self.session_token:
+            cache.invalidate(self.session_token)
+        for attr in ('_is_admin', '_user', '_user_id'):
+            self.__dict__.pop(attr, None)
+
     @property
     def xsrf_token(self):
         if not self._xsrf_token:
@@ -505,6 +1910,12 @@ class Context(object):
     except ImportError:
         pass
 
+    try:
+        from login import get_session_token
+    except ImportError:
+        def get_session_token(self):
+            return self.get_secure_cookie(SESSION_COOKIE)
+
     try:
         from login import get_login_url
     except ImportError:
@@ -517,12 +1928,73 @@ class Context(object):
 
 reqlocal = local()
 
+# Enforce the access constraints of a handler's ``config``. If ``xsrf_verified``
+# is set, the XSRF token is assumed to have been checked already.
+def check_handler_access(ctx, config, kwargs, xsrf_verified=False):
+
+    if config['ssl'] and RUNNING_ON_GOOGLE_SERVERS and not ctx.ssl_mode:
+        raise NotFound
+
+    if config['xsrf'] and not xsrf_verified:
+        if 'xsrf' not in kwargs:
+            raise AuthError("XSRF token not present.")
+        provided_xsrf = kwargs.pop('xsrf')
+        if not secure_string_comparison(provided_xsrf, ctx.xsrf_token):
+            raise AuthError("XSRF tokens do not match.")
+
+    if config['admin'] and not ctx.is_admin:
+        raise NotFound
+
+    if (not config['anon']) and (not ctx.user_id):
+        if ctx.ajax_request:
+            ctx.response_headers['Content-Type'] = 'application/json'
+            raise HTTPContent(encode_json({
+                "error": {
+                    "type": "AuthError",
+                    "redirect": ctx.get_login_url()
+                    }
+                }))
+        raise Redirect(ctx.get_login_url())
+
+# Pass the ``content`` returned by a handler through its ``renderers`` and
+# return the result as a byte string.
+def render_content(ctx, content, renderers):
+
+    for renderer in renderers:
+        if ctx.end_pipeline:
+            break
+        if content is None:
+            content = {
+                'content': ''
+            }
+        elif not isinstance(content, dict):
+            content = {
+                'content': content
+                }
+        if isinstance(renderer, str):
+            content = ctx.render_mako_template(renderer, **content)
+        else:
+            content = renderer(ctx, **content)
+
+    if content is None:
+        content = ''
+    elif isinstance(content, unicode):
+        content = content.encode('utf-8')
+
+    return content
+
 def handle_http_request(
     env, start_response, dict=dict, isinstance=isinstance, urlunquote=urlunquote,
     unicode=unicode, get_response_headers=lambda: None
     ):
 
     reqlocal.template_error_traceback = None
+    reqlocal.memory_sample = memory_sample = None
+    admitted = None
+    ctx = None
+    name = None
+    start = time()
+    timings = {}
 
     try:
 
@@ -537,6 +2009,14 @@ def handle_http_request(
             start_response(*RESPONSE_NOT_IMPLEMENTED)
             return []
 
+        static_files = handle_http_request.static_files
+        if static_files and env['PATH_INFO'].startswith(static_files.prefix):
+            return static_files(env, start_response)
+
+        deferred = handle_http_request.deferred
+        if env['PATH_INFO'].startswith(deferred.task_prefix):
+            return deferred.handle_task(env, start_response)
+
         _path_info = env['PATH_INFO']
         if isinstance(_path_info, unicode):
             _args = [arg for arg in _path_info.split(u'/') if arg]
@@ -581,7 +2061,6 @@ def handle_http_request(
         if router:
             _info = router(ctx, _args, kwargs)
             if not _info:
-                logging.error("No handler found for: %s" % _path_info)
                 raise NotFound
             name, args = _info
         else:
@@ -593,12 +2072,21 @@ def handle_http_request(
                 args = ()
 
         if name not in HANDLERS:
-            logging.error("Handler not found: %s" % name)
+            name = None
             raise NotFound
 
         handler, renderers, config = HANDLERS[name]
         json = config['json']
 
+        if handle_http_request.admission.admit(ctx, name, config):
+            admitted = name
+
+        reqlocal.memory_sample = memory_sample = (
+            handle_http_request.memory_profiler.begin()
+            )
+
+        timings['route'] = time() - start
+
         # Parse the POST body if it exists and is of a known content type.
         if http_method == 'POST':
 
@@ -629,7 +2117,7 @@ def handle_http_request(
                 else:
                     post_encoding = 'utf-8'
 
-                post_data = FieldStorage(
+                post_data = UploadFieldStorage(
                     environ=post_environ, fp=env['wsgi.input'],
                     keep_blank_values=True
                     ).list or []
@@ -652,6 +2140,8 @@ def handle_http_request(
                         continue
                     kwargs[key] = value
 
+        timings['body'] = time() - start
+
         def get_response_headers():
             # Figure out the HTTP headers for the response ``cookies``.
             cookie_output = SimpleCookie()
@@ -694,53 +2184,27 @@ def handle_http_request(
             ctx.ajax_request = 1
             del kwargs['__ajax__']
 
-        if config['ssl'] and RUNNING_ON_GOOGLE_SERVERS and not ssl_mode:
-            raise NotFound
-
-        if config['xsrf']:
-            if 'xsrf' not in kwargs:
-                raise AuthError("XSRF token not present.")
-            provided_xsrf = kwargs.pop('xsrf')
-            if not secure_string_comparison(provided_xsrf, ctx.xsrf_token):
-                raise AuthError("XSRF tokens do not match.")
-
-        if config['admin'] and not ctx.is_admin:
-            raise NotFound
+        check_handler_access(ctx, config, kwargs)
 
-        if (not config['anon']) and (not ctx.user_id):
-            if ctx.ajax_request:
-                ctx.response_headers['Content-Type'] = 'application/json'
-                raise HTTPContent(encode_json({
-                    "error": {
-                        "type": "AuthError",
-                        "redirect": ctx.get_login_url()
-                        }
-                    }))
-            raise Redirect(ctx.get_login_url())
+        # Tell the client about the assets of the templates we'll be rendering,
+        # with a 103 Early Hints response where the server supports it.
+        if PRELOAD_ASSETS and renderers:
+            links = []
+            for renderer in renderers:
+                if isinstance(renderer, str):
+                    links.extend(ctx.preload_template_assets(renderer))
+            early_hints = env.get('wsgi.early_hints')
+            if links and early_hints and EARLY_HINTS:
+                early_hints([('Link', link) for link in links])
 
         # Try and respond with the result of calling the handler.
+        timings['auth'] = time() - start
         content = handler(ctx, *args, **kwargs)
+        timings['handler'] = time() - start
 
-        for renderer in renderers:
-            if ctx.end_pipeline:
-                break
-            if content is None:
-                content = {
-                    'content': ''
-                }
-            elif not isinstance(content, dict):
-                content = {
-                    'content': content
-                    }
-            if isinstance(renderer, str):
-                content = ctx.render_mako_template(renderer, **content)
-            else:
-                content = renderer(ctx, **content)
-
-        if content is None:
-            content = ''
-        elif isinstance(content, unicode):
-            content = content.encode('utf-8')
+        content = render_content(ctx, content, renderers)
+        if renderers:
+            timings['render'] = time() - start
 
         raise HTTPContent(content)
 
@@ -753,21 +2217,24 @@ def handle_http_request(
 
         ctx.response_headers['Content-Length'] = str(len(content))
 
-        start_response(('%d %s\r\n' % ctx._status), get_response_headers())
+        status = ctx._status[0]
+        start_response(('%d %s' % ctx._status), get_response_headers())
         if http_method == 'HEAD':
-            return []
-
-        return [content]
+            response = []
+        else:
+            response = [content]
 
     # Handle 404s.
     except NotFound:
+        status = 404
         start_response(*RESPONSE_404)
-        return [ERROR_404]
+        response = [ERROR_404]
 
     # Handle 401s.
     except AuthError:
+        status = 401
         start_response(*RESPONSE_401)
-        return [ERROR_401]
+        response = [ERROR_401]
 
     # Handle HTTP 301/302 redirects.
     except Redirect, redirect:
@@ -777,40 +2244,331 @@ def handle_http_request(
         headers += [("Content-Type", "text/html; charset=utf-8")]
         headers.append(("Location", redirect.uri))
         if redirect.permanent:
+            status = 301
             start_response(STATUS_301, headers)
         else:
+            status = 302
             start_response(STATUS_302, headers)
-        return []
+        response = []
 
     # Handle other HTTP response codes.
     except HTTPError, error:
+        status = error.code
         start_response(("%s %s" % (error.code, HTTP_STATUS_MESSAGES[error.code])), [])
-        return []
+        response = []
+
+    # Handle requests shed by admission control.
+    except Overloaded, overloaded:
+        status = int(overloaded.status[:3])
+        start_response(overloaded.status, [
+            ("Content-Type", "text/plain; charset=utf-8"),
+            ("Retry-After", str(overloaded.retry_after))
+            ])
+        if http_method == 'HEAD':
+            response = []
+        else:
+            response = [overloaded.status[4:]]
 
     except CapabilityDisabledError:
+        status = 503
         start_response(*RESPONSE_503)
-        return [ERROR_503]
+        response = [ERROR_503]
 
     # Log any errors and return an HTTP 500 response.
     except Exception, error:
+        status = 500
         template_tb = reqlocal.template_error_traceback
-        logging.critical(''.join(format_exception(*sys.exc_info())))
+        logged = handle_http_request.access_log.log_exception(sys.exc_info())
         if DEBUG:
             traceback = ''.join(html_format_exception())
         else:
             traceback = escape("%s: %s" % (error.__class__.__name__, error))
         if template_tb:
-            logging.critical(PlainErrorTemplate.render(traceback=template_tb))
+            if logged:
+                logging.critical(PlainErrorTemplate.render(traceback=template_tb))
             if DEBUG:
                 traceback = HTMLErrorTemplate.render(traceback=template_tb)
         response = ERROR_500_TRACEBACK % traceback
         start_response(*RESPONSE_500)
         if isinstance(response, unicode):
             response = response.encode('utf-8')
-        return [response]
+        response = [response]
+
+    finally:
+        if admitted:
+            handle_http_request.admission.release(admitted)
+        if memory_sample:
+            reqlocal.memory_sample = None
+            handle_http_request.memory_profiler.record(name, memory_sample)
+
+    access_log = handle_http_request.access_log
+    if access_log.enabled:
+        timings['total'] = time() - start
+        for phase, duration in timings.iteritems():
+            timings[phase] = round(duration * 1000, 3)
+        access_log.submit({
+            'bytes': sum(len(chunk) for chunk in response),
+            'cache': ctx and ctx.cache_outcome,
+            'handler': name,
+            'method': env.get('REQUEST_METHOD'),
+            'path': env['PATH_INFO'],
+            'status': status,
+            'time': start,
+            'timings': timings
+            })
+        access_log.end_request()
+
+    if ctx is not None and ctx._deferred:
+        return DeferredResponse(
+            response, ctx._deferred, handle_http_request.deferred
+            )
+
+    return response
 
+handle_http_request.access_log = AccessLog()
+handle_http_request.admission = AdmissionController()
+
+if BACKGROUND_THREADS:
+    handle_http_request.deferred = DeferredQueue(4, LocalTaskQueue())
+elif RUNNING_ON_GOOGLE_SERVERS:
+    handle_http_request.deferred = DeferredQueue(0, AppEngineTaskQueue())
+else:
+    handle_http_request.deferred = DeferredQueue(0)
+
+handle_http_request.memory_profiler = MemoryProfiler(MEMORY_PROFILE_RATE)
 handle_http_request.router = None
 
+if not SESSION_CACHE:
+    handle_http_request.session_cache = None
+elif RUNNING_ON_GOOGLE_SERVERS:
+    from google.appengine.api import memcache
+    handle_http_request.session_cache = SessionCache(memcache)
+else:
+    handle_http_request.session_cache = SessionCache()
+
+if SERVE_STATIC:
+    handle_http_request.static_files = StaticFiles()
+else:
+    handle_http_request.static_files = None
+
+# ------------------------------------------------------------------------------
+# Batch Requests
+# ------------------------------------------------------------------------------
+
+# The batch handler is only registered if ``BATCH_HANDLER`` is set in the
+# config, e.g. to ``'__batch__'``.
+try:
+    from config import BATCH_HANDLER
+except ImportError:
+    BATCH_HANDLER = None
+
+BATCH_MAX_REQUESTS = 20
+BATCH_MAX_WORKERS = 4
+
+# Call ``func`` on each of the ``items`` using up to ``workers`` threads, one of
+# which is the current thread, and return the results in order.
+def run_concurrently(func, items, workers):
+    results = [None] * len(items)
+    queue = deque(enumerate(items))
+    def worker():
+        while 1:
+            try:
+                idx, item = queue.popleft()
+            except IndexError:
+                return
+            results[idx] = func(item)
+    threads = []
+    for _ in range(min(workers, len(items)) - 1):
+        thread = Thread(target=worker)
+        thread.start()
+        threads.append(thread)
+    worker()
+    for thread in threads:
+        thread.join()
+    return results
+
+# Coerce a JSON value from a batch payload to the unicode strings that handlers
+# get from the URL path and query. Other values raise a ``ValueError``.
+def to_request_value(value):
+    if isinstance(value, unicode):
+        return value
+    if isinstance(value, str):
+        return unicode(value, 'utf-8', 'strict')
+    if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+        return unicode(value)
+    raise ValueError("Unsupported value in batch request: %r" % (value,))
+
+# Run a sub-request on a fork of the batch request's context and return the
+# forked context along with a dict describing the response.
+def dispatch_subrequest(parent, name, args, kwargs, xsrf_verified):
+
+    ctx = parent.fork()
+    ctx.ajax_request = 1
+    handler, renderers, config = HANDLERS[name]
+    admission = handle_http_request.admission
+    admitted = None
+    reqlocal.template_error_traceback = None
+
+    try:
+        if admission.admit(ctx, name, config):
+            admitted = name
+        check_handler_access(ctx, config, kwargs, xsrf_verified)
+        raise HTTPContent(
+            render_content(ctx, handler(ctx, *args, **kwargs), renderers)
+            )
+    except HTTPContent, payload:
+        content = payload.content
+        if isinstance(content, str):
+            content = content.decode('utf-8', 'replace')
+        response = {
+            'status': ctx._status[0],
+            'content_type': ctx.response_headers.get(
+                'Content-Type', 'text/html; charset=utf-8'
+                ),
+            'body': content
+            }
+    except NotFound:
+        response = {'status': 404}
+    except AuthError:
+        response = {'status': 401}
+    except Redirect, redirect:
+        response = {
+            'status': redirect.permanent and 301 or 302,
+            'location': redirect.uri
+            }
+    except HTTPError, error:
+        response = {'status': error.code}
+    except Overloaded, overloaded:
+        response = {
+            'status': int(overloaded.status[:3]),
+            'retry_after': overloaded.retry_after
+            }
+    except CapabilityDisabledError:
+        response = {'status': 503}
+    except Exception:
+        handle_http_request.access_log.log_exception(sys.exc_info())
+        response = {'status': 500}
+    finally:
+        if admitted:
+            admission.release(admitted)
+
+    return ctx, response
+
+# The batch handler runs several handlers within a single HTTP request. It takes
+# a JSON payload of the form:
+#
+#   {"requests": [{"handler": name, "args": [...], "kwargs": {...}}, ...],
+#    "xsrf": token, "parallel": true}
+#
+# Each sub-request is routed as if its ``handler`` and ``args`` were the path
+# segments of a URL, i.e. through ``handle_http_request.router`` if one is set.
+# The args and kwargs are coerced to unicode strings, with lists of them allowed
+# for kwargs, as for repeated query parameters.
+#
+# Cookies, the XSRF token and the user/admin lookups are resolved once for the
+# whole batch. Each sub-request is then subject to the usual checks for its
+# handler's config and, unless ``parallel`` is false, run concurrently with the
+# others. The response holds the status of each sub-request in order, and any
+# cookies the sub-requests set are merged in that same order.
+def handle_batch_request(ctx, requests=None, xsrf=None, parallel=True):
+
+    if not isinstance(requests, list) or len(requests) > BATCH_MAX_REQUESTS:
+        raise HTTPError(400)
+
+    items = []
+    responses = [None] * len(requests)
+    need_admin = need_user = need_xsrf = 0
+
+    for idx, request in enumerate(requests):
+        if not isinstance(request, dict):
+            responses[idx] = {'status': 400}
+            continue
+        args = request.get('args') or []
+        kwargs = request.get('kwargs') or {}
+        if not (isinstance(args, list) and isinstance(kwargs, dict)):
+            responses[idx] = {'status': 400}
+            continue
+        try:
+            path = [to_request_value(arg) for arg in [request.get('handler')]]
+            path.extend(to_request_value(arg) for arg in args)
+            _kwargs = {}
+            for key, value in kwargs.iteritems():
+                if isinstance(value, list):
+                    value = [to_request_value(val) for val in value]
+                elif value is not None:
+                    value = to_request_value(value)
+                _kwargs[str(key)] = value
+        except (ValueError, UnicodeError):
+            responses[idx] = {'status': 400}
+            continue
+        router = handle_http_request.router
+        if router:
+            route = router(ctx, path, _kwargs)
+            if not route:
+                responses[idx] = {'status': 404}
+                continue
+            name, args = route
+        else:
+            name, args = path[0], path[1:]
+        if name not in HANDLERS or name == BATCH_HANDLER:
+            responses[idx] = {'status': 404}
+            continue
+        config = HANDLERS[name][2]
+        need_admin |= config['admin']
+        need_user |= not config['anon']
+        need_xsrf |= config['xsrf']
+        items.append((idx, name, args, _kwargs))
+
+    # Resolve the shared state up front, so that the forked contexts inherit it
+    # rather than each looking it up again.
+    xsrf_verified = False
+    if need_xsrf and xsrf:
+        xsrf_verified = secure_string_comparison(xsrf, ctx.xsrf_token)
+    if need_admin:
+        ctx.is_admin
+    if need_user:
+        ctx.user_id
+
+    def dispatch(item):
+        return dispatch_subrequest(ctx, item[1], item[2], item[3], xsrf_verified)
+
+    if parallel:
+        results = run_concurrently(dispatch, items, BATCH_MAX_WORKERS)
+    else:
+        results = [dispatch(item) for item in items]
+
+    cookies = ctx._response_cookies
+    for item, (sub, response) in zip(items, results):
+        responses[item[0]] = response
+        for name in sorted(sub._response_cookies):
+            cookies[name] = sub._response_cookies[name]
+        if sub._deferred:
+            for job in sub._deferred:
+                ctx.defer(job[0], *job[1], **job[2])
+
+    ctx.response_headers['Content-Type'] = 'application/json'
+    return encode_json({'responses': responses})
+
+if BATCH_HANDLER:
+    handle(BATCH_HANDLER, json=True)(handle_batch_request)
+
+# ------------------------------------------------------------------------------
+# Memory Profile Handler
+# ------------------------------------------------------------------------------
+
+def handle_memory_profile(ctx, dump=None, reset=None):
+    profiler = handle_http_request.memory_profiler
+    if dump and profiler.dump_path:
+        profiler.dump()
+    stats = profiler.get_stats()
+    if reset:
+        profiler.reset()
+    ctx.response_headers['Content-Type'] = 'application/json'
+    return encode_json(stats)
+
+if MEMORY_PROFILE_HANDLER:
+    handle(MEMORY_PROFILE_HANDLER, admin=True)(handle_memory_profile)
+
 # ------------------------------------------------------------------------------
 # Template Error Handling
 # ------------------------------------------------------------------------------
@@ -896,9 +2654,9 @@ class MakoTemplateLookup(object):
         'cache_dir': '.',
         'cache_url': 'memcached://',
         'cache_enabled': True,
-        'default_filters': ['decode.utf8'],  # will be shared across instances
+        'default_filters': ['to_unicode'],  # will be shared across instances
         'buffer_filters': [],
-        'imports': None,
+        'imports': ['from weblite import to_unicode'],
         'preprocessor': None
         }
 
@@ -969,13 +2727,24 @@ def get_mako_template(ctx, uri, kwargs=None, lookup=MakoTemplateLookup().get_tem
     return lookup(uri, kwargs)
 
 def call_mako_template(ctx, template, **kwargs):
-    return template.render_unicode(
-        ctx=ctx, STATIC=ctx.STATIC, **kwargs
-        )
+    if PRELOAD_ASSETS:
+        ctx.preload_template_assets(template.uri)
+    parent = getattr(reqlocal, 'memory_sample', None)
+    if not parent:
+        return template.render_unicode(
+            ctx=ctx, STATIC=ctx.STATIC, **kwargs
+            )
+    sample = MemorySample(parent)
+    try:
+        return template.render_unicode(
+            ctx=ctx, STATIC=ctx.STATIC, **kwargs
+            )
+    finally:
+        handle_http_request.memory_profiler.record_template(template.uri, sample)
 
 def render_mako_template(ctx, template_name, **kwargs):
-    return ctx.get_mako_template(template_name).render_unicode(
-        ctx=ctx, STATIC=ctx.STATIC, **kwargs
+    return call_mako_template(
+        ctx, ctx.get_mako_template(template_name), **kwargs
         )
 
 Context.get_mako_template = get_mako_template
@@ -986,10 +2755,32 @@ Context.render_mako_template = render_mako_template
 # HTML Escape
 # ------------------------------------------------------------------------------
 
+# The ``Markup`` type marks a string as safe HTML. The ``to_unicode`` filter
+# passes it through, so that the ``h`` filter within templates leaves it alone.
+# This needs markupsafe, as Mako otherwise escapes with ``legacy_html_escape``,
+# which ignores it.
+try:
+    from markupsafe import Markup
+except ImportError:
+    class Markup(unicode):
+        def __html__(self):
+            return self
+
+# On CPython 2, chained replaces return the same string when nothing matches,
+# and beat both ``unicode.translate`` and regex substitution.
 def escape(s):
     return s.replace(u"&", u"&amp;").replace(u"<", u"&lt;").replace(
         u">", u"&gt;").replace(u'"', u"&quot;")
 
+# The default filter for template expressions. It matches Mako's
+# ``decode.utf8``, which creates a new closure on every call.
+def to_unicode(value):
+    if isinstance(value, unicode):
+        return value
+    if isinstance(value, str):
+        return unicode(value, 'utf-8')
+    return to_unicode(str(value))
+
 # ------------------------------------------------------------------------------
 # WSGI App Alias
 # ------------------------------------------------------------------------------